@@ -1,4 +1,3 @@
-import numpy as np
 import os
 from src.utils import show_image, load_image, save_outputs
 from src.preprocess import preprocess_image
@@ -6,53 +5,81 @@ from src.detect import find_page_contour
 from src.transform import warp_image
 
 
-def process_tiff(image_path, output_path_tiff, output_path_thumb, border_pixels=0, show_step_by_step=False,
-                 show_before_after=False, use_compression=True):
+def process_tiff(image_path, output_path_tiff, output_path_thumb=None, border_pixels=0, show_step_by_step=False,
+                 show_before_after=False, **save_options):
     """
     Full pipeline to process a TIFF image with metadata preservation.
 
     This function processes a TIFF image by loading it, detecting the page contour,
     warping the image to correct perspective, and optionally displaying intermediate steps.
     The processed image is saved to the specified output paths.
+    Batch processing uses warp_page and save_page directly; this function adds the debug displays.
 
     Args:
         image_path (str): Path to the input TIFF image.
         output_path_tiff (str): Path to save the cropped TIFF image.
-        output_path_thumb (str): Path to save the reduced thumbnail.
+        output_path_thumb (str): Path to save the reduced thumbnail. If None, no thumbnail is generated.
         border_pixels (int): Number of pixels for the external border.
         show_step_by_step (bool): If True, shows intermediate steps of the processing.
         show_before_after (bool): If True, shows the original and processed images.
-        use_compression (bool): If True, uses LZW compression for TIFF files (default: True).
+        **save_options: Keyword arguments forwarded to save_outputs (use_compression, codec_workers,
+            verbose, make_thumbnail, compute_quality, thumbnail_format).
 
     Returns:
-        None
-
-    Raises:
-        ValueError: If no page-like contour is found in the image.
+        dict: 'thumbnail' (numpy.ndarray, or None when not built or reused from the cache), 'quality_path'
+        (the quality JSON written for this image, an (archive, member) tuple with an archive thumbnail
+        path, or None) and 'metadata_preserved' (bool, or None if the metadata could not be compared).
 
     Notes:
         - The function uses several utility functions to handle image loading, processing, and saving.
         - The processed image is warped to correct perspective distortions.
     """
-    print(f"Processing image: {image_path}")
-    image = load_image(image_path)
+    if save_options.get("verbose"):
+        print(f"Processing image: {image_path}")
+    image = load_image(image_path, maxworkers=save_options.get("codec_workers"))
     if show_before_after:
         show_image(image, "Original Image")
+    warped, no_cropped = warp_page(image, border_pixels, show_step_by_step)
+    result = save_page(image, image_path, warped, no_cropped, output_path_tiff, output_path_thumb, **save_options)
+    if show_before_after and warped is not None:
+        show_image(warped, "Cropped Image")
+    return result
+
+
+def warp_page(image, border_pixels=0, show_step_by_step=False):
+    """
+    Detect the page in a loaded image and rotate/crop it (the CPU-bound stage of process_tiff).
+
+    Returns:
+        tuple: The warped image and the uncropped, unrotated crop, or (None, None) if no
+        page-like contour is found.
+    """
     thresh, border_value = preprocess_image(image, show_step_by_step)
     page_contour, angle = find_page_contour(thresh, show_step_by_step, original_image=image)
-    copied = False
     if page_contour is None:
-        copied = True
-        warped = np.copy(image)
-        print("No page-like contour found, returning empty image.")
-        thumbnail = save_outputs(image, warped, output_path_tiff, output_path_thumb, 
-                                copied=copied, original_path=image_path, use_compression=use_compression) 
-    else:
-        warped, no_cropped = warp_image(image, page_contour, border_pixels, show_step_by_step, border_value=border_value, angle=angle)
+        return None, None
+    return warp_image(image, page_contour, border_pixels, show_step_by_step,
+                      border_value=border_value, angle=angle)
+
+
+def save_page(image, image_path, warped, no_cropped, output_path_tiff, output_path_thumb=None, **save_options):
+    """
+    Save the result of warp_page. Without a page-like contour the original file is copied as-is.
+
+    Args:
+        **save_options: Keyword arguments forwarded to save_outputs (see process_tiff).
+
+    Returns:
+        dict: The save_outputs result (thumbnail, quality_path, metadata_preserved).
+    """
+    verbose = save_options.get("verbose")
+    if warped is None:
+        if verbose:
+            print("No page-like contour found, copying the original image.")
+        # nessuna copia dei pixel: save_outputs copia direttamente il file originale
+        return save_outputs(image, image, output_path_tiff, output_path_thumb,
+                            copied=True, original_path=image_path, **save_options)
+    if verbose:
         print("Found countour, saving cropped/rotated image.")
-        thumbnail = save_outputs(image, warped, output_path_tiff, output_path_thumb, 
-                                copied=copied, output_no_cropped=no_cropped, original_path=image_path, use_compression=use_compression)
-    if show_before_after:
-        show_image(warped, "Cropped Image")
-    
-    return thumbnail
+    return save_outputs(image, warped, output_path_tiff, output_path_thumb,
+                        output_no_cropped=no_cropped, original_path=image_path, **save_options)
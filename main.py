@@ -5,6 +5,8 @@ import sys
 import time
 from datetime import datetime
 
+import numpy as np
+
 # Aggiungo al path
 current_dir = os.path.dirname(os.path.abspath(__file__))
 src_dir = os.path.join(current_dir, "src")
@@ -12,41 +14,141 @@ src_dir = os.path.join(current_dir, "src")
 sys.path.insert(0, current_dir)  # Per importare edge_detection, report, etc.
 sys.path.insert(0, src_dir)  # Per i moduli src.* usati in edge_detection
 
-from edge_detection import process_tiff
+from edge_detection import process_tiff, save_page, warp_page
 
+from src.pipeline import run_pipeline
 from src.spinner import Spinner
-from src.utils import is_image_valid
+from src.utils import flush_writes, is_archive_path, is_image_valid, load_image, prune_thumbnail_cache
 
 
-def get_file_size_gb(file_path):
-    """Get file size in GB."""
-    return os.path.getsize(file_path) / (1024**3)
+INFO_WRITE_INTERVAL = 1.0  # secondi minimi tra due scritture di info.json
+INFO_WRITE_EVERY = 50  # ...oppure una scrittura ogni N immagini
+# Thread massimi per gli stage di rotazione e codifica: ognuno tiene in memoria una pagina a
+# piena risoluzione più il buffer ruotato (~150-200 MB per una scansione 6000x4500)
+MAX_STAGE_THREADS = 4
 
 
 def write_info_json(output_dir, info_data):
-    """Write info.json file to output directory."""
+    """
+    Write info.json file to output directory.
+
+    The file is written to a temporary path and then moved into place, so a monitoring
+    UI never reads a partially written file.
+    """
     info_path = os.path.join(output_dir, "info.json")
-    with open(info_path, "w", encoding="utf-8") as f:
+    tmp_path = info_path + ".tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
         json.dump(info_data, f, indent=2, ensure_ascii=False)
+    os.replace(tmp_path, info_path)
 
 
-def find_images_recursive(input_dir, format=[".tif", ".tiff", ".jpg", ".jpeg"]):
+IMAGE_EXTENSIONS = (".tif", ".tiff", ".jpg", ".jpeg")
+IMAGE_RECORD_DTYPE = [("path", "O"), ("size", "i8"), ("ext", "i1")]
+
+
+def find_images_recursive(input_dir, format=IMAGE_EXTENSIONS):
     """
     Trova tutti i file tif/tiff/jpg/jpeg ricorsivamente nella directory di input e nelle sue sottocartelle.
 
+    Usa os.scandir, che riusa il tipo di file restituito dal sistema invece di fare una
+    stat() per ogni voce come os.walk. Dimensione ed estensione vengono raccolte nella
+    stessa visita, così totale e istogramma dei formati si calcolano con numpy.
+    L'estensione viene cercata in una tabella con le varianti minuscole, maiuscole e
+    capitalizzate (.tif, .TIF, .Tif), senza splitext né lower() per ogni file; le altre
+    grafie vengono riprovate in minuscolo.
+    Le voci di ogni cartella sono ordinate per nome e le sottocartelle visitate in profondità
+    dopo i file, nell'ordine di os.walk: l'ordine di elaborazione e dei record in info.json
+    è stabile tra un'esecuzione e l'altra.
+
     Args:
         input_dir (str): Directory di input.
+        format (tuple): Estensioni (minuscole) da includere.
+
+    Returns:
+        numpy.ndarray: Array strutturato con campi 'path' (percorso completo), 'size'
+        (byte) ed 'ext' (indice dell'estensione in format).
+    """
+    ext_index = {}
+    for i, ext in enumerate(format):
+        for variant in (ext, ext.upper(), ext[:2].upper() + ext[2:]):
+            ext_index[variant] = i
+    records = []
+    stack = [input_dir]
+    while stack:
+        with os.scandir(stack.pop()) as entries:
+            entries = sorted(entries, key=lambda entry: entry.name)
+        subdirs = []
+        for entry in entries:
+            if entry.is_dir(follow_symlinks=False):
+                subdirs.append(entry.path)
+                continue
+            name = entry.name
+            suffix = name[name.rfind("."):]
+            ext_id = ext_index.get(suffix)
+            if ext_id is None:
+                ext_id = ext_index.get(suffix.lower())  # grafie miste (.tIf, .TiF)
+            if ext_id is not None:
+                records.append((entry.path, entry.stat().st_size, ext_id))
+        # Sottocartelle in ordine inverso sullo stack: vengono visitate in ordine alfabetico,
+        # in profondità, come con os.walk
+        stack.extend(reversed(subdirs))
+    return np.array(records, dtype=IMAGE_RECORD_DTYPE)
+
+
+def _process_one(task):
+    """
+    Elabora una singola immagine, in serie.
+
+    Args:
+        task (tuple): (input_path, output_path, rel_path, options), dove options contiene
+            output_path_thumb, border_pixels, show_step_by_step e in "save" gli argomenti
+            keyword di save_outputs.
 
     Returns:
-        list: Lista dei percorsi completi dei file immagine trovati.
+        tuple: Percorso relativo dell'immagine elaborata ed esito della conservazione dei
+        metadati (True/False, None se non verificabile).
     """
-    image_files = []
-    for root, _, files in os.walk(input_dir):
-        for f in files:
-            ext = os.path.splitext(f)[1].lower()
-            if ext in format:
-                image_files.append(os.path.join(root, f))
-    return image_files
+    input_path, output_path, rel_path, options = task
+    if options["show_step_by_step"]:
+        result = process_tiff(input_path, output_path, options["output_path_thumb"],
+                              options["border_pixels"], show_step_by_step=True, **options["save"])
+        return rel_path, result["metadata_preserved"]
+    return _save_stage(_warp_stage(_load_stage(task)))
+
+
+def _load_stage(task):
+    """Stage 1 della pipeline: decodifica l'immagine."""
+    input_path, _, _, options = task
+    if options["save"]["verbose"]:
+        print(f"Processing image: {input_path}")
+    return task, load_image(input_path, maxworkers=options["save"]["codec_workers"])
+
+
+def _warp_stage(item):
+    """Stage 2 della pipeline: rileva la pagina, ruota e ritaglia."""
+    task, image = item
+    warped, no_cropped = warp_page(image, task[3]["border_pixels"])
+    return task, image, warped, no_cropped
+
+
+def _save_stage(item):
+    """Stage 3 della pipeline: codifica il TIFF, la thumbnail e il JSON di qualità."""
+    (input_path, output_path, rel_path, options), image, warped, no_cropped = item
+    result = save_page(image, input_path, warped, no_cropped, output_path,
+                       options["output_path_thumb"], **options["save"])
+    return rel_path, result["metadata_preserved"]
+
+
+def pipeline_stages(workers):
+    """
+    Divide i thread disponibili tra gli stage: la decodifica ne usa uno, la rotazione
+    (lo stage più pesante) circa due terzi, la codifica il resto.
+    Rotazione e codifica hanno al massimo MAX_STAGE_THREADS thread ciascuna, così le pagine in
+    memoria non crescono con il numero di core.
+    """
+    save_threads = min(MAX_STAGE_THREADS, max(1, workers // 3))
+    warp_threads = min(MAX_STAGE_THREADS, max(1, workers - 1 - save_threads))
+    return [(_load_stage, 1), (_warp_stage, warp_threads), (_save_stage, save_threads)]
 
 
 def main(
@@ -58,6 +160,10 @@ def main(
     image_input_format=None,
     show_step_by_step=False,
     use_compression=True,
+    workers=None,
+    make_thumbnail=True,
+    compute_quality=True,
+    thumbnail_format="jpg",
 ):
     """
     Process images from the input directory (recursively) and save the processed images to the output directory,
@@ -68,9 +174,19 @@ def main(
         output_dir (str): Directory dove salvare le immagini elaborate (struttura replicata).
         border_pixels (int): Numero di pixel per il bordo esterno.
         verbose (bool): Se True, mostra avanzamento.
-        output_path_thumb (str): Percorso per salvare le miniature ridotte (opzionale).
+        output_path_thumb (str): Percorso per salvare le miniature ridotte (opzionale). Se termina
+            con .zip o .tar, miniature e JSON di qualità vengono aggiunti a quell'archivio.
         image_input_format (str): Formato delle immagini di input (tif/jpg).
-        use_compression (bool): Se True, usa compressione LZW per file TIFF (default: True).
+        use_compression (bool): Se True, comprime i file TIFF in output (default: True).
+        workers (int): Numero di thread paralleli (default: os.cpu_count()). Con più di uno le
+            immagini passano in una pipeline decodifica -> rotazione -> codifica, così le tre
+            fasi di immagini diverse si sovrappongono. Con 1, o con show_step_by_step, le
+            immagini vengono elaborate in serie. Ogni thread di rotazione o codifica tiene in
+            memoria una pagina intera, per cui sono limitati a MAX_STAGE_THREADS per stage.
+        make_thumbnail (bool): Se False non crea le miniature (default: True).
+        compute_quality (bool): Se False salta la valutazione della qualità e i relativi JSON,
+            e non verifica la conservazione dei metadati (default: True).
+        thumbnail_format (str): Formato delle miniature, 'jpg' o 'webp' (default: 'jpg').
 
     Returns:
         None
@@ -103,19 +219,20 @@ def main(
         elif format == [".jpeg"]:
             format.append(".jpg")
     else:
-        format = [".tif", ".tiff", ".jpg", ".jpeg"]
+        format = IMAGE_EXTENSIONS
 
-    image_files = find_images_recursive(input_dir, format=format)
+    # Serve la lista completa: conteggio e dimensione totale vanno in info.json
+    format = tuple(format)
+    images = find_images_recursive(input_dir, format=format)
+    image_files = images["path"]
     total_files = len(image_files)
 
     # Calculate total size
-    total_size_gb = sum(get_file_size_gb(f) for f in image_files)
+    total_size_gb = int(images["size"].sum()) / (1024**3)
 
     # Determine primary format
-    formats = {}
-    for f in image_files:
-        ext = os.path.splitext(f)[1].lower()
-        formats[ext] = formats.get(ext, 0) + 1
+    counts = np.bincount(images["ext"], minlength=len(format))
+    formats = {format[k]: int(counts[k]) for k in np.flatnonzero(counts)}
     primary_format = max(formats.keys(), key=formats.get) if formats else "unknown"
 
     # Create initial info.json
@@ -140,65 +257,95 @@ def main(
         output_path_thumb = os.path.abspath(
             os.path.join(os.path.dirname(__file__), "../../../../output/thumbs")
         )
-    os.makedirs(output_path_thumb, exist_ok=True)
-
-    # Crea e avvia lo spinner se richiesto
-    if verbose:
-        spinner = Spinner(total_files)
-        spinner.start()
-
-    for i, input_path in enumerate(image_files):
+    if (make_thumbnail or compute_quality) and is_archive_path(output_path_thumb):
+        # Miniature e JSON di qualità finiscono in un unico archivio .zip/.tar
+        os.makedirs(os.path.dirname(os.path.abspath(output_path_thumb)), exist_ok=True)
+    elif make_thumbnail:
+        os.makedirs(output_path_thumb, exist_ok=True)
+
+    # Prepara i task: salta le immagini già elaborate e crea in anticipo
+    # le cartelle di output, così i thread del pool non vanno in race
+    if workers is None:
+        workers = os.cpu_count() or 1
+    if show_step_by_step:
+        workers = 1  # le finestre di debug richiedono il thread principale
+
+    tasks = []
+    options = {
+        "output_path_thumb": output_path_thumb,
+        "border_pixels": border_pixels,
+        "show_step_by_step": show_step_by_step,
+        # argomenti keyword di save_outputs, passati invariati fino al salvataggio
+        "save": {
+            "use_compression": use_compression,
+            "verbose": verbose,
+            "make_thumbnail": make_thumbnail,
+            "compute_quality": compute_quality,
+            "thumbnail_format": thumbnail_format,
+            # Con più worker, 2 thread di codec TIFF ciascuno evitano l'oversubscription
+            "codec_workers": os.cpu_count() if workers == 1 else 2,
+        },
+    }
+    created_dirs = set()  # le immagini condividono poche cartelle: un makedirs per cartella
+    for input_path in image_files:
         # Calcola il percorso relativo rispetto alla input_dir
         rel_path = os.path.relpath(input_path, input_dir)
         output_path = os.path.join(output_dir, rel_path)
-        already_exists = is_image_valid(output_path)
-        print(
-            f"Processing {i + 1}/{total_files}: {rel_path} (already exists: {already_exists})"
-        )
-        if not already_exists:
-            output_folder = os.path.dirname(output_path)
+        if is_image_valid(output_path):
+            print(f"Skipping {rel_path} (already exists)")
+            continue
+        output_folder = os.path.dirname(output_path)
+        if output_folder not in created_dirs:
             os.makedirs(output_folder, exist_ok=True)
+            created_dirs.add(output_folder)
+        tasks.append((input_path, output_path, rel_path, options))
+    skipped = total_files - len(tasks)
 
-            # Processa il file
-            thumbnail = process_tiff(
-                input_path,
-                output_path,
-                output_path_thumb=output_path_thumb,
-                border_pixels=border_pixels,
-                show_step_by_step=show_step_by_step,
-                show_before_after=False,
-                use_compression=use_compression,
-            )
+    # Crea e avvia lo spinner se richiesto
+    if verbose:
+        spinner = Spinner(total_files)
+        spinner.start()
 
-            # Check if metadata was preserved (read from quality JSON if available)
-            quality_dir = os.path.join(output_path_thumb, "quality")
-            if os.path.exists(quality_dir):
-                quality_files = [
-                    f for f in os.listdir(quality_dir) if f.endswith(".json")
-                ]
-                if quality_files:
-                    latest_quality = sorted(quality_files)[-1]
-                    quality_path = os.path.join(quality_dir, latest_quality)
-                    try:
-                        with open(quality_path, "r") as f:
-                            quality_data = json.load(f)
-                            if "metadata_comparison" in quality_data:
-                                if quality_data["metadata_comparison"].get(
-                                    "metadata_preserved", False
-                                ):
-                                    info_data["successful_metadata_preservation"] += 1
-                                else:
-                                    info_data["failed_metadata_preservation"] += 1
-                    except:
-                        pass
+    pipeline = None
+    use_pipeline = workers > 1 and len(tasks) > 1
+    # Nella pipeline più immagini si salvano già in parallelo: niente thread per immagine
+    options["save"]["parallel"] = not use_pipeline
+    if use_pipeline:
+        results = pipeline = run_pipeline(tasks, pipeline_stages(workers))
+    else:
+        results = map(_process_one, tasks)
+
+    last_info_write = time.monotonic()
+    try:
+        # Solo il thread principale aggiorna spinner e info.json
+        for done, (rel_path, metadata_preserved) in enumerate(results, 1):
+            i = skipped + done - 1
+            print(f"Processed {i + 1}/{total_files}: {rel_path}")
+
+            # Check if metadata was preserved (reported directly by process_tiff)
+            if metadata_preserved is not None:
+                if metadata_preserved:
+                    info_data["successful_metadata_preservation"] += 1
+                else:
+                    info_data["failed_metadata_preservation"] += 1
 
             # Aggiorna lo spinner
             if verbose:
                 spinner.update_progress(i, rel_path)
 
-            # Update progress in info.json
+            # Update progress in info.json (al massimo una volta al secondo o ogni N immagini)
             info_data["processed"] = i + 1
-            write_info_json(output_dir, info_data)
+            now = time.monotonic()
+            if now - last_info_write > INFO_WRITE_INTERVAL or done % INFO_WRITE_EVERY == 0:
+                write_info_json(output_dir, info_data)
+                last_info_write = now
+    finally:
+        if pipeline is not None:
+            pipeline.close()  # ferma i thread della pipeline anche in caso di errore
+        flush_writes()  # le miniature vengono scritte su disco in background
+
+    if make_thumbnail and not is_archive_path(output_path_thumb):
+        prune_thumbnail_cache(output_path_thumb)
 
     # Ferma lo spinner
     if verbose:
@@ -273,7 +420,7 @@ if __name__ == "__main__":
         "--output_thumb",
         type=str,
         default=None,
-        help="Path to save reduced thumbnails (optional).",
+        help="Path to save reduced thumbnails (optional). A .zip or .tar path stores thumbnails and quality JSONs in that archive.",
     )
     parser.add_argument(
         "-f",
@@ -285,7 +432,31 @@ if __name__ == "__main__":
     parser.add_argument(
         "--no-compression",
         action="store_true",
-        help="Disable LZW compression for TIFF files (default: compression enabled).",
+        help="Disable compression for TIFF files (default: compression enabled).",
+    )
+    parser.add_argument(
+        "-w",
+        "--workers",
+        type=int,
+        default=None,
+        help="Number of parallel worker threads (default: number of CPUs). Rotation and saving use "
+        f"at most {MAX_STAGE_THREADS} threads each; every one holds a full-resolution page in memory.",
+    )
+    parser.add_argument(
+        "--no-thumbnails",
+        action="store_true",
+        help="Do not build the before/after thumbnails.",
+    )
+    parser.add_argument(
+        "--thumbnail-format",
+        choices=["jpg", "webp"],
+        default="jpg",
+        help="Thumbnail format: jpg (fast encode) or webp (smaller files).",
+    )
+    parser.add_argument(
+        "--no-quality",
+        action="store_true",
+        help="Skip the quality evaluation and its JSON files.",
     )
 
     args = parser.parse_args()
@@ -307,4 +478,8 @@ if __name__ == "__main__":
         image_input_format=args.image_input_format,
         show_step_by_step=args.show_step_by_step,
         use_compression=not args.no_compression,
+        workers=args.workers,
+        make_thumbnail=not args.no_thumbnails,
+        compute_quality=not args.no_quality,
+        thumbnail_format=args.thumbnail_format,
     )
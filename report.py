@@ -2,6 +2,9 @@ import os
 
 # import shutil
 
+REPORT_WRITE_BATCH = 1000  # frammenti HTML accumulati prima di ogni scrittura
+THUMBNAIL_EXTENSIONS = (".jpg", ".webp")  # miniature JPEG o WebP (--thumbnail-format)
+
 
 def generate_html_report(report_file):
     """
@@ -16,8 +19,8 @@ def generate_html_report(report_file):
 
     output_dir = "tmp"
 
-    # Start the HTML content
-    html_content = """
+    # Start the HTML content (i frammenti vengono uniti una sola volta alla fine)
+    header = """
     <html>
     <head>
         <title>Miniature processate</title>
@@ -37,28 +40,38 @@ def generate_html_report(report_file):
         print(f"Error: The directory {output_dir} does not exist.")
         return
 
-    files = sorted(os.listdir(output_dir))
+    # os.scandir riusa il tipo di file letto con la directory; si ordinano solo le thumbnail
+    with os.scandir(output_dir) as entries:
+        files = sorted(
+            entry.name
+            for entry in entries
+            if entry.is_file() and entry.name.lower().endswith(THUMBNAIL_EXTENSIONS)
+        )
+    prefix = os.path.join(output_dir, "")
+
+    # Write the HTML content to the report file, a batch of fragments at a time
+    with open(report_file, "w", encoding="utf-8", buffering=1 << 20) as f:
+        parts = [header]
 
-    # Iterate over the thumbnails in the output directory
-    for filename in files:
-        if filename.lower().endswith(".jpg"):
-            file_path = os.path.join(output_dir, filename)
-            html_content += f"""
+        # Iterate over the thumbnails in the output directory
+        for filename in files:
+            file_path = prefix + filename
+            parts.append(f"""
             <div class="thumbnail">
                 <img src="{file_path}" alt="{filename}">
-                <p>{filename.replace(".jpg", "")}</p>
+                <p>{os.path.splitext(filename)[0]}</p>
             </div>
-            """
+            """)
+            if len(parts) >= REPORT_WRITE_BATCH:
+                f.writelines(parts)
+                parts.clear()
 
-    # Close the HTML content
-    html_content += """
+        # Close the HTML content
+        parts.append("""
         </div>
     </body>
     </html>
-    """
-
-    # Write the HTML content to the report file
-    with open(report_file, "w") as f:
-        f.write(html_content)
+    """)
+        f.writelines(parts)
 
     print(f"HTML report generated: {report_file}")
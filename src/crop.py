@@ -1,6 +1,5 @@
 import cv2
 import numpy as np
-import matplotlib.pyplot as plt
 from .utils import show_image
 
 
@@ -67,27 +66,37 @@ def plot_corner_discontinuity(binary):
     Returns:
         None
     """
+    # Import pigro: matplotlib serve solo per questo grafico di debug
+    import matplotlib.pyplot as plt
+
+    # Servono solo i quattro bordi: pixel neri = lunghezza - countNonZero, senza maschere H×W
+    H, W = binary.shape[:2]
+    top_black = W - cv2.countNonZero(binary[:1, :])
+    bottom_black = W - cv2.countNonZero(binary[-1:, :])
+    left_black = H - cv2.countNonZero(binary[:, :1])
+    right_black = H - cv2.countNonZero(binary[:, -1:])
+
     fig, axs = plt.subplots(5, 1, figsize=(10, 30))
 
     # Plot top line values
     top_line_values = binary[0, :]
     axs[0].plot(top_line_values)
-    axs[0].set_title(f'Top Line from left to right, number of black pixels: {np.sum(top_line_values == 0)}')
+    axs[0].set_title(f'Top Line from left to right, number of black pixels: {top_black}')
 
     # Plot bottom line values
     bottom_line_values = binary[binary.shape[0] - 1, :]
     axs[1].plot(bottom_line_values)
-    axs[1].set_title(f'Bottom Line from left to right, number of black pixels: {np.sum(bottom_line_values == 0)}')
+    axs[1].set_title(f'Bottom Line from left to right, number of black pixels: {bottom_black}')
 
     # Plot left line values
     left_line_values = binary[:, 0]
     axs[2].plot(left_line_values)
-    axs[2].set_title(f'Left Line from top to bottom, number of black pixels: {np.sum(left_line_values == 0)}')
+    axs[2].set_title(f'Left Line from top to bottom, number of black pixels: {left_black}')
 
     # Plot right line values
     right_line_values = binary[:, binary.shape[1] - 1]
     axs[3].plot(right_line_values)
-    axs[3].set_title(f'Right Line from top to bottom, number of black pixels: {np.sum(right_line_values == 0)}')
+    axs[3].set_title(f'Right Line from top to bottom, number of black pixels: {right_black}')
 
     # Display the binary image
     axs[4].imshow(binary, cmap='gray')
@@ -145,6 +154,8 @@ def navigate_edges(binary, edges):
     Returns:
         dict: Crop points with their respective directions and keep criteria.
     """
+    # Import alla prima chiamata: numba (e la compilazione del kernel) non pesa sull'import di crop
+    from .crop_numba import walk_edge
 
     crop_points = {}
 
@@ -152,19 +163,17 @@ def navigate_edges(binary, edges):
         x, y = edge_data['point']
         direction = edge_data['direction']
         if binary[x, y] == 255:
+            # Ultimo pixel bianco della serie che parte dall'angolo, lungo la colonna e lungo la riga
+            # (l'angolo è bianco, quindi ogni serie è lunga almeno 1)
+            # Con numba il kernel compilato si ferma al primo pixel nero senza scorrere tutta la striscia
             discontinuities = np.array(edge_data['point'])
-            for i in range(binary.shape[0]):
-                point = x + i * direction[0]
-                if binary[point, y] == 255:
-                    discontinuities[0] = point
-                else:
-                    break
-            for i in range(binary.shape[1]):
-                point = y + i * direction[1]
-                if binary[x, point] == 255:
-                    discontinuities[1] = point
-                else:
-                    break
+            if walk_edge is not None:
+                discontinuities[0], discontinuities[1] = walk_edge(binary, x, y, direction[0], direction[1])
+            else:
+                col_run = _leading_run(binary[x::direction[0], y] == 255)
+                row_run = _leading_run(binary[x, y::direction[1]] == 255)
+                discontinuities[0] = x + (col_run - 1) * direction[0]
+                discontinuities[1] = y + (row_run - 1) * direction[1]
 
             linear_distance_from_edge = np.abs(np.array(edge_data['point']) - discontinuities)
             cropping_idx = np.argmin(linear_distance_from_edge)
@@ -217,6 +226,11 @@ def get_binary_edges(cropped, show_step_by_step=False):
 
     return binary, edges
 
+def _leading_run(flags):
+    """Restituisce quanti elementi True consecutivi ci sono all'inizio di un vettore booleano."""
+    not_flags = ~flags
+    return int(np.argmax(not_flags)) if not_flags.any() else flags.size
+
 def crop_black_borders(warped, warped_white, binary):
     """
     Crop the black borders from the warped image using the binary image.
@@ -229,36 +243,19 @@ def crop_black_borders(warped, warped_white, binary):
     Returns:
         tuple: Cropped versions of the warped and warped_white images.
     """
-    # Initialize cropping boundaries
-    top_black, bottom_black, left_black, right_black = 0, binary.shape[0], 0, binary.shape[1]
-
-    # Find the topmost black row
-    for row in range(binary.shape[0]):
-        if np.all(binary[row, :] == 255):
-            top_black = row
-        else:
-            break
-
-    # Find the bottommost black row
-    for row in range(binary.shape[0] - 1, -1, -1):
-        if np.all(binary[row, :] == 255):
-            bottom_black = row
-        else:
-            break
-
-    # Find the leftmost black column
-    for col in range(binary.shape[1]):
-        if np.all(binary[:, col] == 255):
-            left_black = col
-        else:
-            break
-
-    # Find the rightmost black column
-    for col in range(binary.shape[1] - 1, -1, -1):
-        if np.all(binary[:, col] == 255):
-            right_black = col
-        else:
-            break
+    # Righe/colonne interamente bianche (bande nere invertite): il minimo per riga/colonna
+    # con cv2.reduce evita la maschera booleana a piena risoluzione
+    white_rows = cv2.reduce(binary, 1, cv2.REDUCE_MIN).ravel() == 255
+    white_cols = cv2.reduce(binary, 0, cv2.REDUCE_MIN).ravel() == 255
+
+    # top_black/left_black: ultimo indice della serie iniziale di righe/colonne bianche (0 se assente)
+    # bottom_black/right_black: primo indice della serie finale (dimensione intera se assente)
+    top_run = _leading_run(white_rows)
+    left_run = _leading_run(white_cols)
+    top_black = max(top_run - 1, 0)
+    bottom_black = binary.shape[0] - _leading_run(white_rows[::-1])
+    left_black = max(left_run - 1, 0)
+    right_black = binary.shape[1] - _leading_run(white_cols[::-1])
 
     # Crop the images using the found boundaries
     cropped = warped[top_black+1:bottom_black-1, left_black+1:right_black-1]
@@ -0,0 +1,37 @@
+try:
+    from numba import njit
+except ModuleNotFoundError:
+    njit = None
+
+
+if njit is not None:
+
+    @njit(cache=True, boundscheck=False)
+    def walk_edge(binary, x, y, dx, dy):
+        """
+        Cammina dall'angolo (x, y) lungo la colonna (dx) e lungo la riga (dy) finché i pixel
+        restano bianchi, fermandosi al primo pixel nero.
+
+        Args:
+            binary (np.ndarray): Immagine binaria (uint8, 0 o 255).
+            x (int): Riga dell'angolo di partenza (bianco).
+            y (int): Colonna dell'angolo di partenza.
+            dx (int): Direzione lungo le righe (+1 o -1).
+            dy (int): Direzione lungo le colonne (+1 o -1).
+
+        Returns:
+            tuple[int, int]: Ultimo pixel bianco lungo la colonna e lungo la riga.
+        """
+        H, W = binary.shape
+        nx, ny = x, y
+        i = 1
+        while 0 <= x + i * dx < H and binary[x + i * dx, y] == 255:
+            nx = x + i * dx
+            i += 1
+        i = 1
+        while 0 <= y + i * dy < W and binary[x, y + i * dy] == 255:
+            ny = y + i * dy
+            i += 1
+        return nx, ny
+else:
+    walk_edge = None
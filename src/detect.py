@@ -1,10 +1,35 @@
+import heapq
+import threading
+
 import cv2
-import matplotlib.pyplot as plt
 import numpy as np
 from skimage.draw import line as skimage_line
 
 from .utils import show_image
 
+# Kernel di dilatazione costante e buffer di output riusato (uno per thread, come la pipeline)
+_DILATE_K5 = cv2.getStructuringElement(cv2.MORPH_RECT, (5, 5))
+_scratch = threading.local()
+
+# Lato massimo dell'immagine su cui cercare il contorno: oltre, la maschera viene ridotta con
+# cv2.pyrDown e il contorno riportato alla risoluzione piena
+DETECT_MAX_SIDE = 1500
+# Riduzione massima: a scala s la dilatazione copre ~4*s pixel e il contorno cade su una
+# griglia di s pixel, che spostano crop e angolo; oltre 2 lo scarto non è più trascurabile
+DETECT_MAX_SCALE = 2
+
+# Numero massimo di contorni (i più grandi) esaminati come possibile pagina
+DETECT_MAX_CANDIDATES = 10
+
+
+def _dilate_buffer(shape, dtype):
+    """Restituisce il buffer di dilatazione del thread corrente, riallocandolo solo se cambia forma."""
+    buffer = getattr(_scratch, "dilated", None)
+    if buffer is None or buffer.shape != shape or buffer.dtype != dtype:
+        buffer = np.empty(shape, dtype)
+        _scratch.dilated = buffer
+    return buffer
+
 
 def plot_contour_side_distances(approx_contour):
     """
@@ -13,6 +38,9 @@ def plot_contour_side_distances(approx_contour):
     Parameters:
         approx_contour (numpy.ndarray): Contorno approssimato (tipicamente 4 punti per una pagina)
     """
+    # Import pigro: matplotlib serve solo per i grafici di debug
+    import matplotlib.pyplot as plt
+
     # Converti il contour in formato (n, 2)
     points = approx_contour.reshape(-1, 2)
 
@@ -162,10 +190,19 @@ def contour_side_intensity(approx_contour, gray_image, show_plot=False):
         min_index = np.argmin(candidate_array)
         side_inclinations.append(signed_candidate_array[min_index])
     # Calcola media dentro e fuori il box
+    # cv2.mean con maschera evita le copie booleane a piena risoluzione; la media
+    # esterna si ricava dalla somma totale meno quella interna
     mask = np.zeros_like(gray_image, dtype=np.uint8)
     cv2.drawContours(mask, [approx_contour], -1, 255, -1)
-    inside_mean = np.mean(gray_image[mask == 255])
-    outside_mean = np.mean(gray_image[mask == 0])
+    inside_count = cv2.countNonZero(mask)
+    outside_count = mask.size - inside_count
+    inside_mean = cv2.mean(gray_image, mask=mask)[0] if inside_count else np.nan
+    inside_sum = inside_mean * inside_count if inside_count else 0.0
+    outside_mean = (
+        (cv2.sumElems(gray_image)[0] - inside_sum) / outside_count
+        if outside_count
+        else np.nan
+    )
     # Associa centro/background
     side_assoc = []
     for intensity in side_intensities:
@@ -188,6 +225,8 @@ def contour_side_intensity(approx_contour, gray_image, show_plot=False):
                 f"{rank:>3} | {side_intensities[idx]:9.1f} | {side_angles[idx]:17.1f}° | {side_inclinations[idx]:16.1f}° | {side_assoc[idx]}"
             )
     if show_plot:
+        import matplotlib.pyplot as plt  # import pigro, solo in modalità debug
+
         plt.figure(figsize=(12, 6))
         # Subplot 1: Grafico a barre delle intensità ordinate
         plt.subplot(1, 2, 1)
@@ -260,13 +299,14 @@ def contour_side_intensity(approx_contour, gray_image, show_plot=False):
         print(f"Intensità minima: {min(side_intensities):.1f}")
         print(f"Intensità massima: {max(side_intensities):.1f}")
         print(f"Deviazione standard: {np.std(side_intensities):.1f}")
-    for i, intensity in enumerate(side_intensities):
-        print(f"  {side_labels[i]}: {intensity:.1f}")
-    print(f"Inclinazione assoluta media pesata: {mean_weighted_inclination:.2f}°")
+        for i, intensity in enumerate(side_intensities):
+            print(f"  {side_labels[i]}: {intensity:.1f}")
+        print(f"Inclinazione assoluta media pesata: {mean_weighted_inclination:.2f}°")
     mean = np.average(side_inclinations, weights=weights)
     variance = np.average((np.array(side_inclinations) - mean) ** 2, weights=weights)
     std_weighted_inclination = np.sqrt(variance)
-    print(f"Deviazione standard pesata inclinazione: {std_weighted_inclination:.2f}°")
+    if show_plot:
+        print(f"Deviazione standard pesata inclinazione: {std_weighted_inclination:.2f}°")
     # trying removing outliers and average again
     filtered_values = np.array(
         [
@@ -278,8 +318,9 @@ def contour_side_intensity(approx_contour, gray_image, show_plot=False):
     ).T
     if filtered_values.size > 0:
         filtered_inclinations, filtered_side_assoc = filtered_values
-        print("all angles:", side_inclinations)
-        print("non-outliers angles:", filtered_inclinations)
+        if show_plot:
+            print("all angles:", side_inclinations)
+            print("non-outliers angles:", filtered_inclinations)
         if len(filtered_inclinations) > 1:
             weights = [dict_weights[assoc] for assoc in filtered_side_assoc]
             filtered_inclinations = np.array(filtered_inclinations, dtype=float)
@@ -292,12 +333,13 @@ def contour_side_intensity(approx_contour, gray_image, show_plot=False):
                 (np.array(filtered_inclinations) - mean) ** 2, weights=weights
             )
             std_weighted_inclination = np.sqrt(variance)
-            print(
-                f"Nuova inclinazione assoluta media pesata: {mean_weighted_inclination:.2f}°"
-            )
-            print(
-                f"Nuova deviazione standard pesata inclinazione: {std_weighted_inclination:.2f}°"
-            )
+            if show_plot:
+                print(
+                    f"Nuova inclinazione assoluta media pesata: {mean_weighted_inclination:.2f}°"
+                )
+                print(
+                    f"Nuova deviazione standard pesata inclinazione: {std_weighted_inclination:.2f}°"
+                )
 
     return (
         mean_weighted_inclination,
@@ -324,29 +366,55 @@ def find_page_contour(thresh, show_step_by_step=False, original_image=None):
         ValueError: If no page-like contour is found in the image.
 
     Steps:
+        0. Halve the thresholded image with cv2.pyrDown until its longest side is at most
+           DETECT_MAX_SIDE (at most DETECT_MAX_SCALE times); the contour found there is scaled
+           back to full resolution.
         1. Dilate the thresholded image to close small gaps in the contours.
         2. Detect all external contours in the dilated image.
-        3. Sort the contours by area in descending order.
+        3. Keep the DETECT_MAX_CANDIDATES largest contours, ignoring those below 1% of the image.
         4. Approximate each contour to reduce the number of points.
         5. Check if the approximated contour has at least four vertices, indicating a page-like shape.
         6. If a suitable contour is found, return it. Otherwise, raise an error.
     """
-    kernel = np.ones((5, 5), np.uint8)
-    dilated = cv2.dilate(thresh, kernel, iterations=2)
+    scale = 1
+    small = thresh
+    while max(small.shape[:2]) > DETECT_MAX_SIDE and scale < DETECT_MAX_SCALE:
+        small = cv2.pyrDown(small)
+        scale *= 2
+    if scale > 1:
+        # pyrDown sfuma i bordi della maschera: si ribinarizza a metà scala
+        cv2.threshold(small, 127, 255, cv2.THRESH_BINARY, dst=small)
+
+    dilated = cv2.dilate(
+        small, _DILATE_K5, dst=_dilate_buffer(small.shape, small.dtype), iterations=2
+    )
     if show_step_by_step:
         show_image(dilated, "Dilated")
 
     contours, _ = cv2.findContours(dilated, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
-    contours = sorted(contours, key=cv2.contourArea, reverse=True)
+    # Aree calcolate una volta sola; i contorni sotto l'1% dell'immagine non possono essere
+    # una pagina e vengono scartati prima di arcLength/approxPolyDP
+    areas = np.fromiter((cv2.contourArea(c) for c in contours), np.float64, len(contours))
+    min_area = 0.01 * small.shape[0] * small.shape[1]
     angle = None
     approx = None
-    for contour in contours:
+    # Solo i contorni più grandi: heapq.nlargest è O(N) e, a parità di area, stabile
+    for i in heapq.nlargest(DETECT_MAX_CANDIDATES, range(len(contours)), key=areas.__getitem__):
+        if areas[i] < min_area:
+            break  # ordinati per area: anche i successivi sono troppo piccoli
+        contour = contours[i]
+        if len(contour) < 4:
+            continue
         epsilon = 0.02 * cv2.arcLength(contour, True)
         approx = cv2.approxPolyDP(contour, epsilon, True)
         if len(approx) >= 4:
+            if scale > 1:
+                # Riporta contorno e approssimazione alla risoluzione originale
+                contour = contour * scale
+                approx = approx * scale
             rect = cv2.minAreaRect(contour)
             minrect_box = cv2.boxPoints(rect)
-            minrect_box = np.int0(minrect_box)
+            minrect_box = np.intp(minrect_box)
             if show_step_by_step:
                 if original_image is not None:
                     overlay = original_image.copy()
@@ -0,0 +1,110 @@
+import queue
+import threading
+
+_DONE = object()  # sentinella di fine flusso
+
+
+class _Failure:
+    """Eccezione sollevata da uno stage, inoltrata fino al consumatore."""
+
+    def __init__(self, exc):
+        self.exc = exc
+
+
+def _put(q, item, stop_event):
+    """Inserisce item nella coda, rinunciando se la pipeline viene fermata."""
+    while not stop_event.is_set():
+        try:
+            q.put(item, timeout=0.1)
+            return True
+        except queue.Full:
+            pass
+    return False
+
+
+def _get(q, stop_event):
+    """Estrae un elemento dalla coda; restituisce _DONE se la pipeline viene fermata."""
+    while not stop_event.is_set():
+        try:
+            return q.get(timeout=0.1)
+        except queue.Empty:
+            pass
+    return _DONE
+
+
+def run_pipeline(items, stages, queue_size=2):
+    """
+    Esegue una catena di stage su un flusso di elementi, con thread dedicati per ogni stage
+    collegati da code limitate: mentre un'immagine viene ruotata, la successiva viene già
+    decodificata e la precedente codificata.
+
+    Gli stage devono passare quasi tutto il tempo in codice che rilascia il GIL (cv2,
+    tifffile, numpy), altrimenti i thread non lavorano in parallelo.
+
+    Args:
+        items (iterable): Elementi in ingresso al primo stage.
+        stages (list[tuple[callable, int]]): Coppie (funzione, numero di thread); ogni
+            funzione riceve l'output dello stage precedente.
+        queue_size (int): Capienza di ogni coda tra due stage; limita le immagini in memoria.
+
+    Yields:
+        Output dell'ultimo stage, in ordine di completamento.
+
+    Raises:
+        Exception: La prima eccezione sollevata da uno stage, rilanciata nel chiamante.
+    """
+    stop_event = threading.Event()
+    queues = [queue.Queue(maxsize=queue_size) for _ in range(len(stages) + 1)]
+    threads = []
+
+    def feed():
+        for item in items:
+            if not _put(queues[0], item, stop_event):
+                return
+        for _ in range(stages[0][1]):
+            _put(queues[0], _DONE, stop_event)
+
+    threads.append(threading.Thread(target=feed, daemon=True))
+
+    for index, (func, n_threads) in enumerate(stages):
+        in_q, out_q = queues[index], queues[index + 1]
+        n_next = stages[index + 1][1] if index + 1 < len(stages) else 1
+        remaining = [n_threads]
+        lock = threading.Lock()
+
+        def work(func=func, in_q=in_q, out_q=out_q, n_next=n_next, remaining=remaining, lock=lock):
+            while True:
+                item = _get(in_q, stop_event)
+                if item is _DONE:
+                    break
+                if not isinstance(item, _Failure):
+                    try:
+                        item = func(item)
+                    except Exception as e:
+                        item = _Failure(e)
+                if not _put(out_q, item, stop_event):
+                    return
+            # L'ultimo thread dello stage chiude il flusso verso lo stage successivo
+            with lock:
+                remaining[0] -= 1
+                last = remaining[0] == 0
+            if last:
+                for _ in range(n_next):
+                    _put(out_q, _DONE, stop_event)
+
+        threads.extend(threading.Thread(target=work, daemon=True) for _ in range(n_threads))
+
+    for thread in threads:
+        thread.start()
+    try:
+        while True:
+            item = _get(queues[-1], stop_event)
+            if item is _DONE:
+                break
+            if isinstance(item, _Failure):
+                raise item.exc
+            yield item
+    finally:
+        stop_event.set()
+        for thread in threads:
+            thread.join()
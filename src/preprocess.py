@@ -1,3 +1,5 @@
+from functools import lru_cache
+
 import cv2
 import numpy as np
 
@@ -35,23 +37,27 @@ def estimate_threshold_and_border_rgb(image, gray_blurred):
     border = int(min_dim * 0.05)  # 5% per il bordo
     center = int(min_dim * 0.1) // 2  # 10% per il centro
 
-    # Estrai bordi e concatena
-    top = image[:border]
-    bottom = image[-border:]
-    left = image[:, :border]
-    right = image[:, -border:]
-
-    # Calcola media RGB dei bordi
-    border_pixels = np.concatenate(
-        [
-            top.reshape(-1, 3),
-            bottom.reshape(-1, 3),
-            left.reshape(-1, 3),
-            right.reshape(-1, 3),
-        ],
-        axis=0,
-    ).astype(np.float32)
-    border_rgb = tuple(border_pixels.mean(axis=0))  # B, G, R
+    # Estrai la cornice dei bordi: le fasce laterali escludono le righe già coperte da
+    # quella superiore e inferiore, così gli angoli non vengono contati due volte
+    if border > 0:
+        regions = (
+            image[:border],
+            image[-border:],
+            image[border:-border, :border],
+            image[border:-border, -border:],
+        )
+    else:
+        regions = (image,)  # immagine minuscola: media sull'intera immagine
+
+    # Calcola media RGB dei bordi: somme per canale di ciascuna fascia (nessuna copia
+    # né conversione in float), divise per il numero totale di pixel della cornice
+    border_sum = np.zeros(3, dtype=np.float64)
+    border_count = 0
+    for region in regions:
+        if region.size:
+            border_sum += cv2.sumElems(region)[:3]
+            border_count += region.shape[0] * region.shape[1]
+    border_rgb = tuple(border_sum / border_count)  # B, G, R
 
     # Converti media RGB in grigio
     border_gray = rgb_to_gray_from_tuple(border_rgb)
@@ -59,7 +65,7 @@ def estimate_threshold_and_border_rgb(image, gray_blurred):
     # Calcola media nel centro dell'immagine grigia
     cx, cy = w // 2, h // 2
     center_patch = gray_blurred[cy - center : cy + center, cx - center : cx + center]
-    center_mean = center_patch.mean(dtype=np.float32)
+    center_mean = cv2.mean(center_patch)[0]
 
     # Interpolazione pesata
     alpha = 0.6
@@ -81,7 +87,7 @@ def smooth_edges(thresh, show_step_by_step=False):
     Returns:
         np.ndarray: Immagine con bordi più lisci.
     """
-    kernel = np.ones((9, 9), np.uint8)
+    kernel = square_kernel(9)
     eroded = cv2.erode(thresh, kernel, iterations=5)
     dilated = cv2.dilate(eroded, kernel, iterations=5)
 
@@ -103,8 +109,8 @@ def refine_mask_morphology(thresh, show_step_by_step=False):
     Returns:
         np.ndarray: Maschera binaria raffinata.
     """
-    kernel_close = np.ones((15, 15), np.uint8)
-    kernel_open = np.ones((5, 5), np.uint8)
+    kernel_close = square_kernel(15)
+    kernel_open = square_kernel(5)
 
     closed = cv2.morphologyEx(thresh, cv2.MORPH_CLOSE, kernel_close)
     opened = cv2.morphologyEx(closed, cv2.MORPH_OPEN, kernel_open)
@@ -116,6 +122,38 @@ def refine_mask_morphology(thresh, show_step_by_step=False):
     return opened
 
 
+@lru_cache(maxsize=8)
+def square_kernel(size):
+    """
+    Elemento strutturante quadrato size x size per erode/dilate/morphologyEx, allocato una
+    sola volta per dimensione e condiviso tra le chiamate (e i thread).
+
+    Args:
+        size (int): Lato del kernel in pixel.
+
+    Returns:
+        np.ndarray: Kernel di uni (uint8), in sola lettura.
+    """
+    kernel = np.ones((size, size), np.uint8)
+    kernel.flags.writeable = False
+    return kernel
+
+
+@lru_cache(maxsize=None)
+def blur_kernel_size(min_dim):
+    """
+    Dimensione del kernel di blur adattivo per una data dimensione minima dell'immagine.
+
+    Args:
+        min_dim (int): Lato minore dell'immagine in pixel.
+
+    Returns:
+        int: Lato del kernel, dispari, tra 3 e 51.
+    """
+    k = max(3, int((min_dim / 50) // 2 * 2 + 1))  # Kernel dispari, minimo 3
+    return min(k, 51)  # Massimo 51
+
+
 def preprocess_image(image, show_step_by_step=False):
     """
     Converte l'immagine in scala di grigi, la sfoca, calcola soglia dinamica
@@ -129,23 +167,24 @@ def preprocess_image(image, show_step_by_step=False):
         np.ndarray: Immagine binarizzata (uint8, 0 o 255).
         tuple[float, float, float]: Media (B, G, R) dei bordi in float32.
     """
-    # Converte in scala di grigi
-    gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+    # Un solo buffer in scala di grigi: cvtColor, blur e threshold scrivono tutti al suo interno.
+    # Si usa sempre l'array restituito: se l'immagine non è a 8 bit (es. TIFF a 16 bit) OpenCV
+    # ignora dst e ne alloca uno nuovo della profondità giusta
+    gray = np.empty(image.shape[:2], np.uint8)
+    gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY, dst=gray)
     if show_step_by_step:
         show_image(gray, "Grayscale")
 
-    # Applica blur adattivo in base alla dimensione minima
-    min_dim = min(gray.shape[:2])
-    k = max(3, int((min_dim / 50) // 2 * 2 + 1))  # Kernel dispari, minimo 3
-    k = min(k, 51)  # Massimo 51
-    blurred = cv2.GaussianBlur(gray, (k, k), 0)
+    # Applica blur adattivo in base alla dimensione minima (in place)
+    k = blur_kernel_size(min(gray.shape[:2]))
+    gray = cv2.GaussianBlur(gray, (k, k), 0, dst=gray)
     if show_step_by_step:
-        show_image(blurred, f"Blurred (kernel={k}x{k})")
+        show_image(gray, f"Blurred (kernel={k}x{k})")
 
     # Calcola soglia e valore RGB del bordo
-    threshold_val, border_rgb = estimate_threshold_and_border_rgb(image, blurred)
+    threshold_val, border_rgb = estimate_threshold_and_border_rgb(image, gray)
 
-    _, thresh = cv2.threshold(blurred, threshold_val, 255, cv2.THRESH_BINARY)
+    _, thresh = cv2.threshold(gray, threshold_val, 255, cv2.THRESH_BINARY, dst=gray)
 
     thresh = refine_mask_morphology(thresh, False)
 
@@ -13,10 +13,18 @@ def image_entropy(img_gray):
     return entropy
 
 
+def sharpness(img_gray):
+    """Compute sharpness as the variance of the Laplacian."""
+    # Per immagini a 8 bit il Laplaciano (|valori| <= 1020) è esatto in int16: niente buffer float64
+    ddepth = cv2.CV_16S if img_gray.dtype == np.uint8 else cv2.CV_64F
+    _, std = cv2.meanStdDev(cv2.Laplacian(img_gray, ddepth))
+    return float(std[0, 0]) ** 2
+
+
 def edge_density(img_gray):
     """Compute edge density (fraction of edge pixels)."""
     edges = cv2.Canny(img_gray, 100, 200)
-    density = np.sum(edges > 0) / edges.size
+    density = cv2.countNonZero(edges) / edges.size
     return density
 
 
@@ -36,7 +44,7 @@ def estimate_skew_angle(img_gray):
 
 
 def evaluate_quality(
-    original, processed, compute_psnr_ssim=False, compression_info=None
+    original, processed, compute_psnr_ssim=False, compression_info=None, verbose=False
 ):
     """
     Valuta la qualità dell'immagine processata rispetto all'originale.
@@ -49,19 +57,20 @@ def evaluate_quality(
     - PSNR / SSIM opzionali (poco significativi se immagine ruotata)
 
     Args:
-        original (np.ndarray): Crop originale senza rotazione
-        processed (np.ndarray): Crop ruotato
+        original (np.ndarray): Crop originale senza rotazione (BGR o grigi)
+        processed (np.ndarray): Crop ruotato (BGR o grigi)
         compute_psnr_ssim (bool): Se True, calcola anche PSNR / SSIM
         compression_info (str): Information about compression used
+        verbose (bool): Se True, stampa i risultati
 
     Returns:
         dict: Quality evaluation results
     """
 
     # --- Pre-processing ---
-    # Convert to grayscale
-    gray_orig = cv2.cvtColor(original, cv2.COLOR_BGR2GRAY)
-    gray_proc = cv2.cvtColor(processed, cv2.COLOR_BGR2GRAY)
+    # Convert to grayscale (le immagini già a un canale si usano così come sono)
+    gray_orig = original if original.ndim == 2 else cv2.cvtColor(original, cv2.COLOR_BGR2GRAY)
+    gray_proc = processed if processed.ndim == 2 else cv2.cvtColor(processed, cv2.COLOR_BGR2GRAY)
 
     # Crop automatico su area comune
     h_common = min(gray_orig.shape[0], gray_proc.shape[0])
@@ -71,8 +80,8 @@ def evaluate_quality(
     gray_proc_cropped = gray_proc[0:h_common, 0:w_common]
 
     # --- Sharpness ---
-    sharp_orig = cv2.Laplacian(gray_orig_cropped, cv2.CV_64F).var()
-    sharp_proc = cv2.Laplacian(gray_proc_cropped, cv2.CV_64F).var()
+    sharp_orig = sharpness(gray_orig_cropped)
+    sharp_proc = sharpness(gray_proc_cropped)
 
     # --- Entropy ---
     entropy_orig = image_entropy(gray_orig_cropped)
@@ -86,23 +95,26 @@ def evaluate_quality(
     skew_proc = estimate_skew_angle(gray_proc_cropped)
 
     # --- Print Results ---
-    print("=== QUALITY EVALUATION ===")
-    print(f"Sharpness (orig): {sharp_orig:.2f}")
-    print(f"Sharpness (proc): {sharp_proc:.2f}")
-    print(f"Entropy (orig): {entropy_orig:.3f}")
-    print(f"Entropy (proc): {entropy_proc:.3f}")
-    print(f"Edge Density (orig): {edges_orig:.4f}")
-    print(f"Edge Density (proc): {edges_proc:.4f}")
-    print(f"Residual skew angle (proc): {skew_proc:.2f} deg")
+    if verbose:
+        print("=== QUALITY EVALUATION ===")
+        print(f"Sharpness (orig): {sharp_orig:.2f}")
+        print(f"Sharpness (proc): {sharp_proc:.2f}")
+        print(f"Entropy (orig): {entropy_orig:.3f}")
+        print(f"Entropy (proc): {entropy_proc:.3f}")
+        print(f"Edge Density (orig): {edges_orig:.4f}")
+        print(f"Edge Density (proc): {edges_proc:.4f}")
+        print(f"Residual skew angle (proc): {skew_proc:.2f} deg")
 
     # --- Optional PSNR / SSIM ---
     if compute_psnr_ssim:
         psnr_val = cv2.PSNR(gray_orig_cropped, gray_proc_cropped)
         ssim_val = ssim(gray_orig_cropped, gray_proc_cropped)
-        print(f"PSNR: {psnr_val:.2f} dB")
-        print(f"SSIM: {ssim_val:.4f}")
+        if verbose:
+            print(f"PSNR: {psnr_val:.2f} dB")
+            print(f"SSIM: {ssim_val:.4f}")
 
-    print("=========================\n")
+    if verbose:
+        print("=========================\n")
 
     results = {
         "sharpness": {"original": sharp_orig, "processed": sharp_proc},
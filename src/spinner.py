@@ -5,9 +5,12 @@ import threading
 class Spinner:
     def __init__(self, total_files):
         self.stop_event = threading.Event()
-        self.spinner_thread = threading.Thread(target=self._spinner_task)
+        # daemon: se il thread principale termina con un errore il processo non resta appeso
+        self.spinner_thread = threading.Thread(target=self._spinner_task, daemon=True)
         self.total_files = total_files
-        self.start_time = time.time()
+        self.start_time = time.monotonic()
+        # Le 51 possibili barre di avanzamento, costruite una volta sola
+        self._bars = [f"[{filled * '='}{(50 - filled) * ' '}]" for filled in range(51)]
 
     def _spinner_task(self):
         spinner = ['|', '/', '-', '\\']
@@ -16,7 +19,7 @@ class Spinner:
             sys.stdout.write(f"\r{spinner[idx % len(spinner)]} Processing: ")
             sys.stdout.flush()
             idx += 1
-            time.sleep(0.1)
+            self.stop_event.wait(0.1)  # si sveglia subito quando viene chiamato stop()
 
     def start(self):
         self.spinner_thread.start()
@@ -26,12 +29,12 @@ class Spinner:
         self.spinner_thread.join()
 
     def update_progress(self, current_file, filename):
-        elapsed_time = time.time() - self.start_time
+        elapsed_time = time.monotonic() - self.start_time
         avg_time_per_file = elapsed_time / (current_file + 1)
         remaining_time = avg_time_per_file * (self.total_files - (current_file + 1))
         progress = (current_file + 1) / self.total_files * 100
 
         # Update progress information
-        progress_bar = f"[{int(progress // 2) * '='}{(50 - int(progress // 2)) * ' '}]"
+        progress_bar = self._bars[min(int(progress // 2), 50)]
         sys.stdout.write(f"\r  Processing: {filename} ({current_file + 1}/{self.total_files}) {progress_bar} {progress:.2f}% | Elapsed: {elapsed_time:.2f}s | Remaining: {remaining_time:.2f}s")
         sys.stdout.flush()
\ No newline at end of file
@@ -1,8 +1,26 @@
+import math
+
 import cv2
 import numpy as np
 
 from .utils import show_image
 
+# Margine (pixel) attorno al box ruotato analizzato da irregolar_border
+CROP_MARGIN = 200
+
+# Sotto questo angolo (gradi) la pagina non viene ruotata: una rotazione di pochi decimi di
+# grado sposta i bordi di pochi pixel ma costa un'interpolazione dell'intera finestra
+MIN_ROTATION_ANGLE = 0.1
+
+# Formati pyvips corrispondenti ai dtype numpy (chiave: dtype.str senza l'endianness)
+VIPS_FORMATS = {"u1": "uchar", "u2": "ushort", "f4": "float"}
+
+# Rotazione su GPU se OpenCV è compilato con i moduli CUDA (cudawarping) e c'è un device
+try:
+    CUDA_WARP = cv2.cuda.getCudaEnabledDeviceCount() > 0 and hasattr(cv2.cuda, "warpAffine")
+except (AttributeError, cv2.error):
+    CUDA_WARP = False
+
 
 def crop_image(image, box, border_pixels=0):
     """Crop image around a box with optional border padding."""
@@ -26,12 +44,12 @@ def calculate_subject_intensity(gray_image, box, crop_offset=200):
     Returns:
         int: Average intensity value inside the box
     """
-    box_coords = cv2.boundingRect(box)
-    x_box, y_box, w_box, h_box = box_coords
+    _, _, w_box, h_box = cv2.boundingRect(box)
 
-    # Adjust box coordinates to cropped image coordinate system
-    x_box_adj = x_box - (cv2.boundingRect(box)[0] - crop_offset)
-    y_box_adj = y_box - (cv2.boundingRect(box)[1] - crop_offset)
+    # Adjust box coordinates to cropped image coordinate system: the crop starts crop_offset
+    # pixels before the box, so the box starts at crop_offset (x_box - (x_box - crop_offset))
+    x_box_adj = crop_offset
+    y_box_adj = crop_offset
 
     # Ensure coordinates are within image bounds
     h_img, w_img = gray_image.shape[:2]
@@ -69,13 +87,18 @@ def create_similarity_mask(gray_image, border_intensity, subject_intensity):
         subject_intensity: Expected intensity of subject/content pixels
 
     Returns:
-        numpy.ndarray: Binary mask (0 or 1 values)
+        numpy.ndarray: Binary mask (uint8, 0 or 1 values)
     """
-    border_diff = np.abs(gray_image.astype(np.float32) - border_intensity)
-    subject_diff = np.abs(gray_image.astype(np.float32) - subject_intensity)
-
-    # Pixels closer to subject than to border get value 1
-    return np.where(subject_diff < border_diff, 1.0, 0.0)
+    # Pixels closer to subject than to border get value 1. Il confronto è la stessa formula in
+    # float32 di sempre, ma per un'immagine a 8 bit viene valutato una sola volta per ciascuno
+    # dei 256 livelli (intensità float comprese, nessun arrotondamento) e applicato con cv2.LUT,
+    # senza copie float dell'immagine
+    if gray_image.dtype == np.uint8:
+        levels = np.arange(256, dtype=np.float32)
+        lut = (np.abs(levels - subject_intensity) < np.abs(levels - border_intensity)).astype(np.uint8)
+        return cv2.LUT(gray_image, lut)
+    gray = gray_image.astype(np.float32)
+    return (np.abs(gray - subject_intensity) < np.abs(gray - border_intensity)).view(np.uint8)
 
 
 def find_mask_bounding_box(similarity_mask):
@@ -83,21 +106,19 @@ def find_mask_bounding_box(similarity_mask):
     Find the bounding box of non-zero regions in the similarity mask.
 
     Args:
-        similarity_mask: Binary mask where 1 indicates content pixels
+        similarity_mask: Binary uint8 mask where 1 indicates content pixels
 
     Returns:
         tuple: (x, y, w, h) bounding box coordinates, or None if no content found
     """
-    non_zero_y, non_zero_x = np.nonzero(similarity_mask > 0.5)
-    if non_zero_y.size == 0 or non_zero_x.size == 0:
+    # countNonZero/boundingRect lavorano sulla maschera uint8 senza creare array di indici
+    if cv2.countNonZero(similarity_mask) == 0:
         return None
 
-    top = np.min(non_zero_y)
-    bottom = np.max(non_zero_y)
-    left = np.min(non_zero_x)
-    right = np.max(non_zero_x)
+    left, top, width, height = cv2.boundingRect(similarity_mask)
 
-    return left, top, right - left, bottom - top
+    # w/h come distanza tra primo e ultimo pixel di contenuto (non il numero di pixel)
+    return left, top, width - 1, height - 1
 
 
 def irregolar_border(image, box, border_value, step_by_step=False):
@@ -119,11 +140,12 @@ def irregolar_border(image, box, border_value, step_by_step=False):
     """
     # Calculate the crop offset to convert back to original coordinates
     box_rect = cv2.boundingRect(box)
-    crop_offset_x = max(0, box_rect[0] - 200)
-    crop_offset_y = max(0, box_rect[1] - 200)
+    crop_offset_x = max(0, box_rect[0] - CROP_MARGIN)
+    crop_offset_y = max(0, box_rect[1] - CROP_MARGIN)
 
     # Create a large crop around the detected box for analysis
-    crop_large = crop_image(image.copy(), box, 200)
+    # crop_image restituisce una vista: qui viene solo letta (blur/cvtColor allocano il proprio output)
+    crop_large = crop_image(image, box, CROP_MARGIN)
 
     # Apply strong blur to focus on large regions rather than fine details
     kernel_size = max(21, min(crop_large.shape[:2]) // 20)
@@ -147,7 +169,7 @@ def irregolar_border(image, box, border_value, step_by_step=False):
         gray = blurred_crop
 
     # Calculate subject intensity from the box region
-    subject_intensity = calculate_subject_intensity(gray, box, crop_offset=200)
+    subject_intensity = calculate_subject_intensity(gray, box, crop_offset=CROP_MARGIN)
 
     # Create binary similarity mask
     similarity_mask = create_similarity_mask(gray, border_intensity, subject_intensity)
@@ -156,7 +178,7 @@ def irregolar_border(image, box, border_value, step_by_step=False):
         print(
             f"Border intensity: {border_intensity}, Subject intensity: {subject_intensity}"
         )
-        show_image(similarity_mask, "Similarity Mask", max_width=800, max_height=600)
+        show_image(similarity_mask * 255, "Similarity Mask", max_width=800, max_height=600)
 
     # Find bounding box of content regions
     bbox = find_mask_bounding_box(similarity_mask)
@@ -225,6 +247,8 @@ def warp_image(
     border_value=(0, 0, 0),
     angle=None,
     opencv_version=True,
+    interpolation=cv2.INTER_CUBIC,
+    min_angle=MIN_ROTATION_ANGLE,
 ):
     """
     Applica una trasformazione affine per raddrizzare una pagina rilevata nell'immagine,
@@ -239,12 +263,19 @@ def warp_image(
         border_value (tuple[int, int, int]): Colore di riempimento nei bordi (B, G, R).
         angle (float): Angolo di rotazione in gradi; se None, viene calcolato automaticamente.
         opencv_version (bool): Se True, usa OpenCV per la rotazione; altrimenti pyvips.
+        interpolation (int): Interpolazione OpenCV per la rotazione. Default: cv2.INTER_CUBIC,
+            molto più veloce di cv2.INTER_LANCZOS4 con differenze minime per rotazioni di pochi gradi.
+        min_angle (float): Angolo minimo (gradi, in valore assoluto) per cui si ruota l'immagine;
+            sotto viene solo ritagliata. Default: MIN_ROTATION_ANGLE.
 
     Returns:
         cropped (np.ndarray): Immagine ritagliata e raddrizzata.
         crop_no_rotation (np.ndarray): Ritaglio rettangolare originale senza rotazione.
     """
 
+    # Buffer C-contiguo: i kernel SIMD di OpenCV lavorano senza copie intermedie
+    image = np.ascontiguousarray(image)
+
     # Ottiene il rettangolo minimo che racchiude il contorno
     rect = cv2.minAreaRect(page_contour)
     center_box = rect[0]  # centro del rettangolo
@@ -254,7 +285,7 @@ def warp_image(
     # Corregge l’angolo se è quasi verticale
     if angle > 80:
         angle -= 90
-    angle = -angle  # Inverte direzione della rotazione per OpenCV
+    angle = -float(angle)  # Inverte direzione della rotazione per OpenCV
 
     # Estrae il box e il crop prima della rotazione
     box = cv2.boxPoints(rect)
@@ -266,71 +297,108 @@ def warp_image(
     w0 += int(border_pixels * 2)
     crop_no_rotation = image[y0 : y0 + h0, x0 : x0 + w0]
 
-    # Calcola matrice di rotazione (usata in entrambi i metodi)
-    M = cv2.getRotationMatrix2D(center_box, -angle, 1.0)
+    # Matrice di rotazione attorno al centro del box (usata in entrambi i metodi), costruita
+    # direttamente da coseno e seno come cv2.getRotationMatrix2D(center_box, -angle, 1.0),
+    # in float32 come il box
+    theta = math.radians(-angle)
+    cos, sin = math.cos(theta), math.sin(theta)
+    cx, cy = center_box
+    M = np.array(
+        [[cos, sin, (1 - cos) * cx - sin * cy], [-sin, cos, sin * cx + (1 - cos) * cy]],
+        dtype=np.float32,
+    )
 
-    # Se l'angolo è zero (o molto vicino), salta la rotazione
-    print(angle)
-    if abs(angle) < 1e-3:
-        rotated_np = image.copy()
-        M = np.eye(2, 3, dtype=np.float32)
+    # Se l'angolo è zero (o sotto min_angle), salta la rotazione
+    if show_step_by_step:
+        print(angle)
+    if abs(angle) < max(min_angle, 1e-3):
+        rotated_np = image  # nessuna copia: a valle l'immagine viene solo letta e ritagliata
         rotated_box = box.astype(np.float32)
     else:
-        if opencv_version:
-            # Calcola le nuove dimensioni dell’immagine dopo rotazione
-            cos = np.abs(M[0, 0])
-            sin = np.abs(M[0, 1])
-            new_w = int(image.shape[0] * sin + image.shape[1] * cos)
-            new_h = int(image.shape[0] * cos + image.shape[1] * sin)
-
-            # Aggiusta la traslazione per centrare l'immagine
-            M[0, 2] += (new_w - image.shape[1]) / 2
-            M[1, 2] += (new_h - image.shape[0]) / 2
-
-            # Applica la rotazione con interpolazione Lanczos4 (alta qualità)
+        # Calcola le nuove dimensioni dell’immagine dopo rotazione
+        new_w = int(image.shape[0] * abs(sin) + image.shape[1] * abs(cos))
+        new_h = int(image.shape[0] * abs(cos) + image.shape[1] * abs(sin))
+
+        # Aggiusta la traslazione per centrare l'immagine
+        M[0, 2] += (new_w - image.shape[1]) / 2
+        M[1, 2] += (new_h - image.shape[0]) / 2
+
+        # Del risultato servono solo il box ruotato e il margine letto da irregolar_border
+        # (più il bordo extra): si ruota direttamente quella finestra, spostando la
+        # traslazione di M, invece dell'intera immagine
+        # Il box ruotato (4 punti: un prodotto matriciale numpy) si calcola una volta sola e
+        # serve sia per la finestra sia, spostato nelle sue coordinate, per il ritaglio
+        margin = CROP_MARGIN + int(border_pixels)
+        rotated_box = box.astype(np.float32) @ M[:, :2].T + M[:, 2]
+        bx, by, bw, bh = cv2.boundingRect(rotated_box)
+        win_x0, win_y0 = max(0, bx - margin), max(0, by - margin)
+        win_w = min(new_w, bx + bw + margin) - win_x0
+        win_h = min(new_h, by + bh + margin) - win_y0
+        M[0, 2] -= win_x0
+        M[1, 2] -= win_y0
+        rotated_box -= (win_x0, win_y0)
+
+        if opencv_version and CUDA_WARP:
+            # Rotazione su GPU: si carica l'immagine e si scarica solo la finestra ruotata
+            image_gpu = cv2.cuda_GpuMat()
+            image_gpu.upload(image)
+            rotated_gpu = cv2.cuda.warpAffine(
+                image_gpu,
+                M,
+                (win_w, win_h),
+                flags=interpolation,
+                borderMode=cv2.BORDER_CONSTANT,
+                borderValue=border_value,
+            )
+            rotated_np = rotated_gpu.download()
+
+        elif opencv_version:
+            # Applica la rotazione (bicubica di default)
+            # Buffer di destinazione senza inizializzazione: warpAffine scrive ogni pixel
+            rotated_np = np.empty((win_h, win_w) + image.shape[2:], dtype=image.dtype)
             rotated_np = cv2.warpAffine(
                 image,
                 M,
-                (new_w, new_h),
-                flags=cv2.INTER_LANCZOS4,
+                (win_w, win_h),
+                dst=rotated_np,
+                flags=interpolation,
                 borderMode=cv2.BORDER_CONSTANT,
                 borderValue=border_value,
             )
 
         else:
-            # Rotazione tramite pyvips (nohalo), attorno all'origine
+            # Rotazione tramite pyvips (nohalo) con la stessa matrice M: vips legge il buffer
+            # numpy senza copiarlo e, essendo a richiesta, calcola solo la finestra (oarea)
             try:
                 import pyvips
 
                 height, width = image.shape[:2]
                 bands = image.shape[2] if len(image.shape) == 3 else 1
-                linear = image.reshape(height * width * bands)
                 vips_image = pyvips.Image.new_from_memory(
-                    linear.tobytes(), width, height, bands, "uchar"
+                    image.data, width, height, bands, VIPS_FORMATS[image.dtype.str[1:]]
                 )
 
-                angle_rad = np.radians(angle)
-                a, b = np.cos(angle_rad), -np.sin(angle_rad)
-                c, d = np.sin(angle_rad), np.cos(angle_rad)
-
                 rotated = vips_image.affine(
-                    [a, b, c, d], interpolate=pyvips.Interpolate.new("nohalo")
+                    M[:, :2].ravel().tolist(),
+                    interpolate=pyvips.Interpolate.new("nohalo"),
+                    odx=float(M[0, 2]),
+                    ody=float(M[1, 2]),
+                    oarea=[0, 0, win_w, win_h],
                 )
                 rotated_mem = rotated.write_to_memory()
-                rotated_np = (
-                    np.frombuffer(rotated_mem, dtype=np.uint8)
-                    .reshape(rotated.height, rotated.width, rotated.bands)
-                    .copy()
+                # Sola lettura e senza copia: a valle la finestra viene solo letta e ritagliata
+                # (stessa forma dell'output OpenCV: 2D per le immagini in scala di grigi)
+                rotated_np = np.frombuffer(rotated_mem, dtype=image.dtype).reshape(
+                    (rotated.height, rotated.width) + image.shape[2:]
                 )
             except ModuleNotFoundError as e:
                 print(f"ModuleNotFoundError: {e}")
             except Exception as e:
                 print(f"Exception while cropping with pyvips: {e}")
 
-    # Trasforma il box originale con la matrice di rotazione per ritagliare il contenuto corretto
-    rotated_box = cv2.transform(np.array([box], dtype="float32"), M)[0]
+    # Ritaglia il contenuto corretto attorno al box ruotato
     crop_coords = irregolar_border(
-        rotated_np.copy(), rotated_box, border_value, show_step_by_step
+        rotated_np, rotated_box, border_value, show_step_by_step
     )
 
     if crop_coords is not None:
@@ -354,11 +422,15 @@ def warp_image(
     if show_step_by_step:
         if show_overlay:
             overlay = cropped.copy()
-            overlay_contour = rotated_box.copy()
-            overlay_contour[:, 0] -= x
-            overlay_contour[:, 1] -= y
-            cv2.drawContours(
-                overlay, [overlay_contour.astype(np.int32)], -1, (0, 255, 0), 15
+            overlay_contour = (rotated_box - (x, y)).astype(np.int32)
+            # Polilinea chiusa senza antialiasing, spessore proporzionale alla larghezza
+            cv2.polylines(
+                overlay,
+                [overlay_contour],
+                True,
+                (0, 255, 0),
+                max(2, overlay.shape[1] // 500),
+                cv2.LINE_8,
             )
             show_image(overlay, "Rotated and Cropped (with original contour)")
         else:
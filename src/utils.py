@@ -1,10 +1,56 @@
+import atexit
 import cv2
+import functools
 import os
 import numpy as np
+import hashlib
 import json
+import shutil
+import tarfile
+import threading
 import time
+import zipfile
+from concurrent.futures import ThreadPoolExecutor
+from io import BytesIO
 from .quality_evaluation import evaluate_quality
-from PIL import Image
+
+try:
+    import tifffile
+except ModuleNotFoundError:
+    tifffile = None
+
+try:
+    import imagecodecs
+except ModuleNotFoundError:
+    imagecodecs = None
+
+# Codec per i TIFF compressi: zstd se imagecodecs lo fornisce, altrimenti deflate (zlib è sempre disponibile).
+# Livello 1: a parità di thread codifica molte volte più veloce, con file poco più grandi.
+if imagecodecs is not None and getattr(getattr(imagecodecs, 'ZSTD', None), 'available', False):
+    TIFF_COMPRESSION = ('zstd', 'zstd')
+else:
+    TIFF_COMPRESSION = ('zlib', 'deflate')
+TIFF_COMPRESSION_LEVEL = 1
+
+# Parametri per i TIFF scritti con cv2.imwrite quando serve compressione:
+# deflate (8) con predittore orizzontale (2), lossless
+CV2_TIFF_COMPRESSED = [int(cv2.IMWRITE_TIFF_COMPRESSION), 8, int(cv2.IMWRITE_TIFF_PREDICTOR), 2]
+# JPEG a piena qualità come PIL (quality=100, subsampling=0): qualità 100, croma 4:4:4
+CV2_JPEG_MAX = [int(cv2.IMWRITE_JPEG_QUALITY), 100,
+                int(cv2.IMWRITE_JPEG_SAMPLING_FACTOR), int(cv2.IMWRITE_JPEG_SAMPLING_FACTOR_444)]
+# Miniature JPEG: qualità 85 con tabelle di Huffman ottimizzate (file più piccoli, stessa immagine)
+CV2_THUMBNAIL_JPEG = [int(cv2.IMWRITE_JPEG_QUALITY), 85, int(cv2.IMWRITE_JPEG_OPTIMIZE), 1]
+# Miniature WebP (opzionali): a qualità 85 file molto più piccoli del JPEG, ma codifica più lenta
+CV2_THUMBNAIL_WEBP = [int(cv2.IMWRITE_WEBP_QUALITY), 85]
+# Formato della miniatura -> (estensione, parametri di cv2.imencode)
+THUMBNAIL_ENCODERS = {
+    'jpg': ('.jpg', CV2_THUMBNAIL_JPEG),
+    'webp': ('.webp', CV2_THUMBNAIL_WEBP),
+}
+try:
+    WEBP_AVAILABLE = cv2.imencode('.webp', np.zeros((1, 1, 3), np.uint8))[0]
+except cv2.error:
+    WEBP_AVAILABLE = False  # OpenCV compilato senza libwebp
 
 
 DEFAULT_ERROR = {
@@ -14,6 +60,8 @@ DEFAULT_ERROR = {
     'residual_skew_angle': 0.1,
 }
 
+_WINDOWS = set()  # titoli delle finestre di debug già create da show_image
+
 def show_image(image, title="Image", max_width=1280, max_height=720, file_path=None):
     """
     Resize and display an image with a title. Waits for a key press to close.
@@ -30,23 +78,214 @@ def show_image(image, title="Image", max_width=1280, max_height=720, file_path=N
     """
     height, width = image.shape[:2]
     scale = min(max_width / width, max_height / height, 1)
-    resized_image = cv2.resize(image, (int(width * scale), int(height * scale)))
+    size = (int(width * scale), int(height * scale))
 
     if not file_path:
-        cv2.imshow(title, resized_image)
+        # Finestra ridimensionabile creata una volta per titolo: la riduzione per lo schermo la fa
+        # la GUI di OpenCV, senza una copia ridimensionata dell'immagine a piena risoluzione
+        if title not in _WINDOWS:
+            cv2.namedWindow(title, cv2.WINDOW_NORMAL | cv2.WINDOW_KEEPRATIO)
+            _WINDOWS.add(title)
+        cv2.resizeWindow(title, *size)
+        cv2.imshow(title, image)
         cv2.waitKey(0)
 
     # this is for educational purposes
     if file_path:
-        cv2.imwrite(file_path, resized_image)
+        # scale <= 1: a scala piena l'immagine si salva così com'è, senza un resize che la copia
+        cv2.imwrite(file_path, image if scale == 1 else cv2.resize(image, size, interpolation=cv2.INTER_AREA))
+
+
+# Flag di cv2.imread per le letture ridotte di load_image (fattore -> flag). Per i JPEG
+# libjpeg scala già nel dominio DCT, decodificando solo una parte dei coefficienti
+IMREAD_REDUCED_FLAGS = {
+    2: cv2.IMREAD_REDUCED_COLOR_2,
+    4: cv2.IMREAD_REDUCED_COLOR_4,
+    8: cv2.IMREAD_REDUCED_COLOR_8,
+}
+
+
+def load_image(image_path, maxworkers=None, reduce=1):
+    """
+    Load the input image from the given path.
+
+    TIFF files are decoded with tifffile when it is installed, which decompresses
+    strips/tiles in parallel threads. Any other format, or a TIFF layout that
+    tifffile cannot hand back in OpenCV channel order, is read with cv2.imread.
+    With reduce > 1 the image is read by cv2.imread at 1/2, 1/4 or 1/8 of its size,
+    for callers that only need a preview (e.g. a thumbnail), never for the warp.
+
+    Args:
+        image_path (str): Path of the image to load.
+        maxworkers (int): Threads used by tifffile to decode the image (default: tifffile's choice).
+        reduce (int): Scale reduction factor, 1 (full resolution), 2, 4 or 8. Reduced reads
+            are always BGR.
+
+    Returns:
+        numpy.ndarray: Image in OpenCV layout (BGR, BGRA or grayscale), always C-contiguous
+        so the cv2 kernels downstream never need to make their own copy. None if unreadable.
+    """
+    if reduce != 1:
+        image = cv2.imread(image_path, IMREAD_REDUCED_FLAGS[reduce])
+        return None if image is None else np.ascontiguousarray(image)
+    image = None
+    if tifffile is not None and image_path.lower().endswith(('.tif', '.tiff')):
+        image = read_tiff(image_path, maxworkers=maxworkers)
+    if image is None:
+        image = cv2.imread(image_path, cv2.IMREAD_UNCHANGED)
+    if image is None:
+        return None
+    return np.ascontiguousarray(image)  # no-op se è già contiguo
+
+
+def read_tiff(image_path, maxworkers=None):
+    """
+    Read the first page of a TIFF with tifffile and convert it to OpenCV channel order.
+
+    Args:
+        image_path (str): Path of the TIFF file.
+        maxworkers (int): Threads used to decode strips/tiles.
+
+    Returns:
+        numpy.ndarray: BGR, BGRA or grayscale image, or None if the file uses a layout
+        (palette, planar, YCbCr, missing codec, ...) better left to cv2.imread.
+    """
+    try:
+        with tifffile.TiffFile(image_path) as tif:
+            page = tif.pages[0]
+            if (
+                page.photometric not in (tifffile.PHOTOMETRIC.MINISBLACK, tifffile.PHOTOMETRIC.RGB)
+                or page.planarconfig != tifffile.PLANARCONFIG.CONTIG
+                or page.bitspersample not in (8, 16)
+            ):
+                return None
+            image = page.asarray(maxworkers=maxworkers)
+    except Exception:
+        # e.g. LZW/JPEG compressed files when imagecodecs is not installed
+        return None
+
+    if image.ndim == 2:
+        return image
+    if image.ndim == 3 and image.shape[2] == 3:
+        return cv2.cvtColor(image, cv2.COLOR_RGB2BGR)
+    if image.ndim == 3 and image.shape[2] == 4:
+        return cv2.cvtColor(image, cv2.COLOR_RGBA2BGRA)
+    return None
+
+
+def save_tiff(image_array, output_path, use_compression=True, dpi=None, icc_profile=None, maxworkers=None):
+    """
+    Save an image as TIFF with tifffile.
+
+    With compression enabled the strips are compressed in parallel threads with zstd
+    (or deflate when imagecodecs is missing) at level 1, instead of going through the
+    single-threaded libtiff LZW encoder used by PIL/OpenCV.
+
+    Args:
+        image_array (np.ndarray): Image to save (BGR, BGRA or grayscale, uint8 or uint16).
+        output_path (str): Destination path.
+        use_compression (bool): If True, uses zstd/deflate compression (see TIFF_COMPRESSION).
+        dpi (tuple): Optional (x, y) resolution in dots per inch.
+        icc_profile (bytes): Optional ICC profile to embed.
+        maxworkers (int): Threads used to compress strips (default: tifffile's choice).
+
+    Returns:
+        str: Compression used ('zstd', 'deflate' or 'raw').
+    """
+    if image_array.ndim == 3 and image_array.shape[2] == 3:
+        data = cv2.cvtColor(image_array, cv2.COLOR_BGR2RGB)
+        photometric = 'rgb'
+    elif image_array.ndim == 3 and image_array.shape[2] == 4:
+        data = cv2.cvtColor(image_array, cv2.COLOR_BGRA2RGBA)
+        photometric = 'rgb'
+    else:
+        data = image_array
+        photometric = 'minisblack'
+
+    save_kwargs = {'photometric': photometric, 'maxworkers': maxworkers}
+    if use_compression:
+        save_kwargs['compression'] = TIFF_COMPRESSION[0]
+        save_kwargs['compressionargs'] = {'level': TIFF_COMPRESSION_LEVEL}
+    if dpi:
+        save_kwargs['resolution'] = (float(dpi[0]), float(dpi[1]))
+        save_kwargs['resolutionunit'] = 'INCH'
+    if icc_profile:
+        save_kwargs['iccprofile'] = icc_profile
+
+    tifffile.imwrite(output_path, data, **save_kwargs)
+    return TIFF_COMPRESSION[1] if use_compression else 'raw'
+
+
+def to_pil_image(image_array):
+    """Convert a BGR/grayscale array to a PIL image."""
+    # Import pigro: PIL serve solo per i metadati e per i formati non gestiti da OpenCV/tifffile
+    from PIL import Image
+
+    if image_array.ndim == 3 and image_array.dtype == np.uint8 and image_array.shape[2] in (3, 4):
+        # PIL legge direttamente il buffer BGR(A) riordinando i canali mentre lo importa:
+        # nessuna immagine RGB intermedia (né cvtColor né la copia di una vista [..., ::-1])
+        mode, rawmode = ('RGB', 'BGR') if image_array.shape[2] == 3 else ('RGBA', 'BGRA')
+        height, width = image_array.shape[:2]
+        return Image.frombuffer(mode, (width, height), np.ascontiguousarray(image_array),
+                                'raw', rawmode, 0, 1)
+    if len(image_array.shape) == 3:
+        image_rgb = cv2.cvtColor(image_array, cv2.COLOR_BGR2RGB)
+    else:
+        image_rgb = image_array
+    return Image.fromarray(image_rgb)
+
+
+def _jpeg_with_metadata(jpeg, exif=None, dpi=None):
+    """
+    Aggiunge EXIF e DPI a un JPEG codificato da OpenCV, lavorando solo sugli header.
+
+    La densità (DPI) viene scritta nel segmento JFIF (APP0) e l'EXIF in un segmento APP1
+    inserito subito dopo, come fa PIL.
+
+    Args:
+        jpeg (bytes): JPEG codificato con cv2.imencode.
+        exif (bytes): Payload EXIF come in PIL.Image.info['exif'] (inizia con 'Exif' e due byte nulli).
+        dpi (tuple): Risoluzione (x, y) in punti per pollice.
+
+    Returns:
+        bytes: Il JPEG con i metadati, o None se non è possibile (serve il fallback PIL).
+    """
+    if jpeg[:4] != b'\xff\xd8\xff\xe0' or jpeg[6:11] != b'JFIF\x00':
+        return None
+    if exif is not None and len(exif) > 65533:
+        return None
+    header_end = 4 + int.from_bytes(jpeg[4:6], 'big')  # fine del segmento APP0
+    app0 = bytearray(jpeg[:header_end])
+    if dpi:
+        app0[13] = 1  # unità: punti per pollice
+        app0[14:18] = b''.join(min(int(round(d)), 65535).to_bytes(2, 'big') for d in dpi[:2])
+    app1 = b''
+    if exif:
+        app1 = b'\xff\xe1' + (len(exif) + 2).to_bytes(2, 'big') + exif
+    return bytes(app0) + app1 + jpeg[header_end:]
+
 
+@functools.lru_cache(maxsize=64)
+def _image_header(path, mtime_ns, size):
+    """Legge con PIL solo gli header di un'immagine (Image.open non decodifica i pixel)."""
+    from PIL import Image
 
-def load_image(image_path):
-    """Load the input image from the given path."""
-    return cv2.imread(image_path, cv2.IMREAD_UNCHANGED)
+    with Image.open(path) as image:
+        exif = image._getexif() if hasattr(image, '_getexif') else None
+        return dict(image.info), image.mode, image.size, exif
 
 
-def save_image_with_metadata(image_array, output_path, original_path, use_compression=True):
+def read_image_header(path):
+    """
+    Restituisce (info, mode, size, exif) dell'immagine, letti una sola volta per file:
+    la chiave della cache include mtime e dimensione, quindi un file modificato viene riletto.
+    Il dizionario info è condiviso, non va modificato.
+    """
+    stat = os.stat(path)
+    return _image_header(path, stat.st_mtime_ns, stat.st_size)
+
+
+def save_image_with_metadata(image_array, output_path, original_path, use_compression=True, maxworkers=None):
     """
     Salva un'immagine preservando i metadati EXIF senza perdita di qualità.
     
@@ -54,7 +293,8 @@ def save_image_with_metadata(image_array, output_path, original_path, use_compre
         image_array (np.ndarray): Array dell'immagine da salvare (BGR format)
         output_path (str): Path dove salvare l'immagine
         original_path (str): Path dell'immagine originale (per i metadati)
-        use_compression (bool): Se True, usa compressione LZW per TIFF (default: True)
+        use_compression (bool): Se True, comprime i TIFF (zstd/deflate con tifffile, altrimenti LZW) (default: True)
+        maxworkers (int): Thread usati da tifffile per comprimere le strip del TIFF
         
     Returns:
         dict: Metadata information including original and saved metadata
@@ -70,90 +310,107 @@ def save_image_with_metadata(image_array, output_path, original_path, use_compre
     }
     
     try:
-        # Convert BGR to RGB for PIL
-        if len(image_array.shape) == 3:
-            image_rgb = cv2.cvtColor(image_array, cv2.COLOR_BGR2RGB)
-        else:
-            image_rgb = image_array
-            
-        pil_image = Image.fromarray(image_rgb)
         output_ext = os.path.splitext(output_path)[1].lower()
         metadata_info["format"] = output_ext.upper().replace('.', '')
         
-        # Load metadata from original
-        with Image.open(original_path) as original:
-            # Extract readable metadata
-            readable_metadata = {}
-            for key, value in original.info.items():
+        # Metadati dell'originale: solo gli header (cache condivisa con compare_metadata),
+        # i pixel dell'originale non vengono mai letti
+        original_info, _, _, exif_dict = read_image_header(original_path)
+        # Extract readable metadata
+        readable_metadata = {}
+        for key, value in original_info.items():
+            try:
+                readable_metadata[str(key)] = str(value)
+            except:
+                readable_metadata[str(key)] = "non-serializable"
+
+        # Add EXIF if available
+        if exif_dict:
+            for tag_id, value in exif_dict.items():
                 try:
-                    readable_metadata[str(key)] = str(value)
+                    readable_metadata[f"EXIF_{tag_id}"] = str(value)
                 except:
-                    readable_metadata[str(key)] = "non-serializable"
-            
-            # Add EXIF if available
-            if hasattr(original, '_getexif') and original._getexif():
-                exif_dict = original._getexif()
-                for tag_id, value in exif_dict.items():
-                    try:
-                        readable_metadata[f"EXIF_{tag_id}"] = str(value)
-                    except:
-                        readable_metadata[f"EXIF_{tag_id}"] = "non-serializable"
+                    readable_metadata[f"EXIF_{tag_id}"] = "non-serializable"
+        
+        metadata_info["original_metadata"] = readable_metadata
+        
+        if output_ext in ['.tiff', '.tif'] and tifffile is not None and 'exif' not in original_info:
+            # TIFF handling with tifffile (multi-threaded compression, keeps the ICC profile)
+            metadata_info["compression"] = save_tiff(
+                image_array,
+                output_path,
+                use_compression=use_compression,
+                dpi=original_info.get('dpi'),
+                icc_profile=original_info.get('icc_profile'),
+                maxworkers=maxworkers,
+            )
+            metadata_info["metadata_preserved"] = True
+
+        elif output_ext in ['.tiff', '.tif']:
+            # TIFF handling
+            pil_image = to_pil_image(image_array)
+            compression_type = 'tiff_lzw' if use_compression else 'raw'
+            save_kwargs = {'format': 'TIFF', 'compression': compression_type}
             
-            metadata_info["original_metadata"] = readable_metadata
+            # Add metadata (excluding ICC profile if using compression to avoid conflicts)
+            if 'dpi' in original_info:
+                save_kwargs['dpi'] = original_info['dpi']
+            if 'exif' in original_info:
+                save_kwargs['exif'] = original_info['exif']
+            if not use_compression and 'icc_profile' in original_info:
+                save_kwargs['icc_profile'] = original_info['icc_profile']
             
-            if output_ext in ['.tiff', '.tif']:
-                # TIFF handling
-                compression_type = 'tiff_lzw' if use_compression else 'raw'
-                save_kwargs = {'format': 'TIFF', 'compression': compression_type}
-                
-                # Add metadata (excluding ICC profile if using compression to avoid conflicts)
-                if 'dpi' in original.info:
-                    save_kwargs['dpi'] = original.info['dpi']
-                if 'exif' in original.info:
-                    save_kwargs['exif'] = original.info['exif']
-                if not use_compression and 'icc_profile' in original.info:
-                    save_kwargs['icc_profile'] = original.info['icc_profile']
-                
-                pil_image.save(output_path, **save_kwargs)
-                metadata_info["compression"] = 'lzw' if use_compression else 'raw'
-                metadata_info["metadata_preserved"] = True
-                if use_compression:
-                    metadata_info["notes"] = "LZW compression applied, ICC profile excluded to avoid conflicts"
-                    
-            elif output_ext in ['.png']:
-                # PNG handling
-                from PIL import PngImagePlugin
-                pnginfo = PngImagePlugin.PngInfo()
-                for key, value in original.info.items():
-                    if isinstance(key, str) and isinstance(value, str):
-                        pnginfo.add_text(key, value)
-                
-                pil_image.save(output_path, format='PNG', pnginfo=pnginfo)
-                metadata_info["compression"] = "lossless"
-                metadata_info["metadata_preserved"] = bool(pnginfo)
-                
-            elif output_ext in ['.jpg', '.jpeg']:
-                # JPEG handling
-                save_kwargs = {'format': 'JPEG', 'quality': 100, 'optimize': False, 'subsampling': 0}
-                if 'exif' in original.info:
-                    save_kwargs['exif'] = original.info['exif']
-                if 'dpi' in original.info:
-                    save_kwargs['dpi'] = original.info['dpi']
-                
-                pil_image.save(output_path, **save_kwargs)
-                metadata_info["compression"] = "quality_100"
-                metadata_info["metadata_preserved"] = 'exif' in original.info
+            pil_image.save(output_path, **save_kwargs)
+            metadata_info["compression"] = 'lzw' if use_compression else 'raw'
+            metadata_info["metadata_preserved"] = True
+            if use_compression:
+                metadata_info["notes"] = "LZW compression applied, ICC profile excluded to avoid conflicts"
                 
+        elif output_ext in ['.png']:
+            # PNG handling
+            from PIL import PngImagePlugin
+            pnginfo = PngImagePlugin.PngInfo()
+            for key, value in original_info.items():
+                if isinstance(key, str) and isinstance(value, str):
+                    pnginfo.add_text(key, value)
+            
+            pil_image = to_pil_image(image_array)
+            pil_image.save(output_path, format='PNG', pnginfo=pnginfo)
+            metadata_info["compression"] = "lossless"
+            metadata_info["metadata_preserved"] = bool(pnginfo)
+            
+        elif output_ext in ['.jpg', '.jpeg']:
+            # JPEG handling: OpenCV codifica direttamente il BGR (stessi parametri di PIL:
+            # qualità 100, 4:4:4), poi EXIF e DPI vengono inseriti negli header del buffer
+            success, encoded = cv2.imencode('.jpg', image_array, CV2_JPEG_MAX)
+            data = _jpeg_with_metadata(encoded.tobytes(), original_info.get('exif'),
+                                       original_info.get('dpi')) if success else None
+            if data is not None:
+                with open(output_path, 'wb') as f:
+                    f.write(data)
             else:
-                # Default handling
-                save_kwargs = {}
-                if 'exif' in original.info:
-                    save_kwargs['exif'] = original.info['exif']
+                save_kwargs = {'format': 'JPEG', 'quality': 100, 'optimize': False, 'subsampling': 0}
+                if 'exif' in original_info:
+                    save_kwargs['exif'] = original_info['exif']
+                if 'dpi' in original_info:
+                    save_kwargs['dpi'] = original_info['dpi']
+
+                pil_image = to_pil_image(image_array)
                 pil_image.save(output_path, **save_kwargs)
-                metadata_info["metadata_preserved"] = 'exif' in original.info
-            
-            metadata_info["saved_successfully"] = True
+            metadata_info["compression"] = "quality_100"
+            metadata_info["metadata_preserved"] = 'exif' in original_info
             
+        else:
+            # Default handling
+            save_kwargs = {}
+            if 'exif' in original_info:
+                save_kwargs['exif'] = original_info['exif']
+            pil_image = to_pil_image(image_array)
+            pil_image.save(output_path, **save_kwargs)
+            metadata_info["metadata_preserved"] = 'exif' in original_info
+        
+        metadata_info["saved_successfully"] = True
+        
     except Exception as e:
         metadata_info["error"] = str(e)
         print(f"Error in save_image_with_metadata: {e}")
@@ -165,6 +422,9 @@ def save_image_with_metadata(image_array, output_path, original_path, use_compre
             elif output_path.lower().endswith('.png'):
                 cv2.imwrite(output_path, image_array, [cv2.IMWRITE_PNG_COMPRESSION, 0])
                 metadata_info["compression"] = "opencv_lossless"
+            elif output_path.lower().endswith(('.tiff', '.tif')) and use_compression:
+                cv2.imwrite(output_path, image_array, CV2_TIFF_COMPRESSED)
+                metadata_info["compression"] = "opencv_deflate"
             else:
                 cv2.imwrite(output_path, image_array)
                 metadata_info["compression"] = "opencv_raw"
@@ -187,11 +447,13 @@ def compare_metadata(original_path, output_path):
     
     try:
         # Read metadata from both files
-        with Image.open(original_path) as original_img:
-            original_metadata = original_img.info.copy()
-            original_metadata['mode'] = original_img.mode
-            original_metadata['size'] = str(original_img.size)
+        original_info, original_mode, original_size, _ = read_image_header(original_path)
+        original_metadata = original_info.copy()
+        original_metadata['mode'] = original_mode
+        original_metadata['size'] = str(original_size)
         
+        from PIL import Image
+
         with Image.open(output_path) as output_img:
             output_metadata = output_img.info.copy()
             output_metadata['mode'] = output_img.mode
@@ -250,99 +512,524 @@ def compare_metadata(original_path, output_path):
     
     return comparison
 
-def save_outputs(original, processed, output_path_tiff, output_path_thumb=None, copied=False, output_no_cropped=None, original_path=None, use_compression=True):
+_write_executor = None  # thread che scrivono su disco i buffer già codificati
+_pending_writes = set()
+
+
+def _write_bytes(path, data, link_path=None):
     """
-    Save the processed TIFF image, a reduced JPG thumbnail, and the quality evaluation JSON.
-    Always saves both original and processed images in the thumbnail, and always saves the quality file.
-    Now also preserves metadata from original images.
+    Scrive un buffer già codificato su disco (eseguita in background da write_file_async).
+
+    Il file viene scritto accanto con estensione .tmp e poi spostato al suo posto con
+    os.replace (atomico): chi legge, ad esempio la galleria delle miniature, non vede mai un
+    file scritto a metà, e un file esistente viene sostituito da un nuovo inode invece di
+    essere troncato (non altera eventuali hard link, come quelli della cache delle miniature).
     """
-    if copied:
-        processed = np.zeros_like(original)  # If copied, processed is an empty image
-    
-    # Save the processed TIFF with metadata preservation
-    metadata_info = None
-    if original_path:
-        metadata_info = save_image_with_metadata(processed, output_path_tiff, original_path, use_compression)
+    tmp_path = path + '.tmp'
+    try:
+        with open(tmp_path, 'wb') as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+        if link_path is not None:
+            link_or_copy(path, link_path)
+    except OSError as e:
+        print(f"Warning: Failed to write {path}: {e}")
+
+
+def link_or_copy(src, dst):
+    """
+    Rende dst un hard link a src (una copia se il file system non li supporta), sostituendo
+    atomicamente un dst esistente tramite un .tmp e os.replace.
+    """
+    if os.path.exists(dst) and os.path.samefile(src, dst):
+        return  # già collegati (os.replace tra due link allo stesso file non fa nulla)
+    tmp_path = dst + '.tmp'
+    if os.path.lexists(tmp_path):
+        os.remove(tmp_path)
+    try:
+        os.link(src, tmp_path)
+    except OSError:
+        shutil.copyfile(src, tmp_path)
+    os.replace(tmp_path, dst)
+
+
+def write_file_async(path, data, link_path=None):
+    """
+    Scrive data (bytes o array uint8 già codificato) in path su un thread in background, così
+    la scrittura su disco si sovrappone alla codifica e all'elaborazione delle immagini successive.
+    Se link_path è dato, dopo la scrittura link_path diventa un hard link a path (vedi link_or_copy).
+    Usare flush_writes() per attendere la fine di tutte le scritture.
+
+    Returns:
+        concurrent.futures.Future: Completato quando il file è stato scritto.
+    """
+    global _write_executor
+    if _write_executor is None:
+        _write_executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix='writer')
+    future = _write_executor.submit(_write_bytes, path, data, link_path)
+    _pending_writes.add(future)
+    future.add_done_callback(_pending_writes.discard)
+    return future
+
+
+ARCHIVE_EXTENSIONS = ('.zip', '.tar')  # output_path_thumb con queste estensioni è un archivio
+
+_archives = {}  # percorso -> (archivio aperto in scrittura, nomi scritti, archivio precedente o None)
+_archives_lock = threading.Lock()
+
+
+def is_archive_path(path):
+    """True se path indica un archivio (.zip/.tar) invece di una cartella."""
+    return bool(path) and path.lower().endswith(ARCHIVE_EXTENSIONS)
+
+
+def _open_archive(archive_path):
+    """
+    Apre archive_path in scrittura. Un archivio già esistente (run precedente) viene spostato
+    in '<archive>.old': i suoi file vengono ricopiati da _close_archive, tranne quelli riscritti
+    in questa esecuzione, così nessun file compare due volte.
+    """
+    os.makedirs(os.path.dirname(os.path.abspath(archive_path)), exist_ok=True)
+    previous = archive_path + '.old'
+    if os.path.exists(previous):
+        # .old di un'esecuzione interrotta: resta la base, l'archivio incompleto viene scartato
+        pass
+    elif os.path.exists(archive_path):
+        os.replace(archive_path, previous)
     else:
+        previous = None
+    if archive_path.lower().endswith('.zip'):
+        # JPEG già compressi e JSON piccoli: nessuna ricompressione
+        archive = zipfile.ZipFile(archive_path, 'w', zipfile.ZIP_STORED)
+    else:
+        archive = tarfile.open(archive_path, 'w')
+    return archive, set(), previous
+
+
+def _close_archive(archive_path, archive, written, previous):
+    """Ricopia dall'archivio precedente i file non riscritti, poi chiude e rimuove il .old."""
+    if previous is not None:
+        try:
+            if isinstance(archive, zipfile.ZipFile):
+                with zipfile.ZipFile(previous) as old:
+                    for info in old.infolist():
+                        if info.filename not in written:
+                            archive.writestr(info, old.read(info))
+                            written.add(info.filename)
+            else:
+                with tarfile.open(previous) as old:
+                    for info in old.getmembers():
+                        if info.isfile() and info.name not in written:
+                            archive.addfile(info, old.extractfile(info))
+                            written.add(info.name)
+        except (OSError, tarfile.TarError, zipfile.BadZipFile) as e:
+            print(f"Warning: Failed to merge {previous} into {archive_path}: {e}")
+            archive.close()
+            return  # il .old resta su disco, nulla va perso
+    archive.close()
+    if previous is not None:
+        os.remove(previous)
+
+
+def _append_member(archive_path, name, data):
+    """Aggiunge un file all'archivio (eseguita in background da append_to_archive_async)."""
+    data = bytes(data)
+    try:
+        with _archives_lock:
+            entry = _archives.get(archive_path)
+            if entry is None:
+                entry = _archives[archive_path] = _open_archive(archive_path)
+            archive, written, _ = entry
+            if name in written:
+                # Riscritto nella stessa esecuzione: zip e tar non sostituiscono un membro
+                print(f"Warning: {name} already written to {archive_path}, skipped")
+                return
+            if isinstance(archive, zipfile.ZipFile):
+                archive.writestr(name, data)
+            else:
+                info = tarfile.TarInfo(name)
+                info.size = len(data)
+                info.mtime = time.time()
+                archive.addfile(info, BytesIO(data))
+            written.add(name)
+    except (OSError, tarfile.TarError, zipfile.BadZipFile) as e:
+        print(f"Warning: Failed to add {name} to {archive_path}: {e}")
+
+
+def append_to_archive_async(archive_path, name, data):
+    """
+    Come write_file_async, ma aggiunge data come file name dentro un archivio .zip/.tar
+    aperto una volta sola: niente creazione di un file per ogni miniatura/JSON.
+    L'archivio viene chiuso (e reso leggibile) da flush_writes(), che vi ricopia i file di
+    un archivio preesistente non riscritti in questa esecuzione.
+
+    Returns:
+        concurrent.futures.Future: Completato quando il file è stato aggiunto.
+    """
+    global _write_executor
+    if _write_executor is None:
+        _write_executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix='writer')
+    future = _write_executor.submit(_append_member, archive_path, name, data)
+    _pending_writes.add(future)
+    future.add_done_callback(_pending_writes.discard)
+    return future
+
+
+def flush_writes():
+    """Attende la fine di tutte le scritture avviate con write_file_async e chiude gli archivi."""
+    for future in list(_pending_writes):
+        future.result()
+    with _archives_lock:
+        for archive_path, entry in _archives.items():
+            _close_archive(archive_path, *entry)
+        _archives.clear()
+
+
+atexit.register(flush_writes)  # nessuna miniatura o JSON perso se il programma termina prima
+
+
+_loop_executor = None  # pool condiviso da tutte le chiamate a mt_loop
+_loop_executor_lock = threading.Lock()
+
+
+def _get_loop_executor():
+    """Crea al primo uso il pool di thread condiviso da mt_loop."""
+    global _loop_executor
+    with _loop_executor_lock:
+        if _loop_executor is None:
+            _loop_executor = ThreadPoolExecutor(max_workers=os.cpu_count() or 1, thread_name_prefix='loop')
+        return _loop_executor
+
+
+def mt_loop(fn, iterable, max_workers=None):
+    """
+    Applica fn a ogni elemento di iterable con il pool di thread condiviso del modulo.
+
+    Utile per lavoro che rilascia il GIL (codec, cv2, I/O su file). Il pool viene creato una
+    volta sola; le chiamate annidate (fn che a sua volta usa mt_loop) girano in serie, così
+    il pool non può bloccarsi in attesa di se stesso.
+
+    Args:
+        fn (callable): Funzione da applicare.
+        iterable (iterable): Elementi in ingresso.
+        max_workers (int): Numero massimo di elementi in esecuzione contemporanea
+            (default: la dimensione del pool, os.cpu_count()).
+
+    Returns:
+        list: Risultati di fn, nello stesso ordine degli elementi.
+    """
+    items = list(iterable)
+    if len(items) <= 1 or max_workers == 1 or threading.current_thread().name.startswith('loop'):
+        return [fn(item) for item in items]
+    pool = _get_loop_executor()
+    if not max_workers:
+        return list(pool.map(fn, items))
+    results = []
+    for start in range(0, len(items), max_workers):
+        results.extend(pool.map(fn, items[start:start + max_workers]))
+    return results
+
+
+THUMBNAIL_WIDTH = 800  # larghezza delle miniature
+THUMBNAIL_SEPARATOR = 100  # larghezza (a piena risoluzione) del separatore nero
+
+def _as_bgr(image):
+    """
+    Restituisce l'immagine a 3 canali BGR. Un'immagine in grigi (H×W o H×W×1) diventa una vista
+    np.broadcast_to con passo 0 sui canali, senza copiarla; BGRA viene convertita con cvtColor.
+    """
+    if image.ndim == 2:
+        return np.broadcast_to(image[..., None], image.shape + (3,))
+    if image.shape[2] == 1:
+        return np.broadcast_to(image, image.shape[:2] + (3,))
+    if image.shape[2] == 4:
+        return cv2.cvtColor(image, cv2.COLOR_BGRA2BGR)
+    return image
+
+
+def _resize_into(src, dst, interpolation):
+    """
+    cv2.resize di src direttamente nel buffer dst. Le viste in grigi di _as_bgr vengono
+    ridimensionate sul solo piano di grigi e replicate sui 3 canali alla risoluzione di dst,
+    invece di lasciare che OpenCV copi l'intera vista a piena risoluzione.
+    """
+    size = (dst.shape[1], dst.shape[0])
+    if src.ndim == 3 and src.strides[2] == 0:
+        dst[...] = cv2.resize(src[..., 0], size, interpolation=interpolation)[..., None]
+    else:
+        cv2.resize(src, size, dst=dst, interpolation=interpolation)
+
+
+def build_thumbnail(original, processed, copied=False):
+    """
+    Costruisce la miniatura originale | separatore | elaborata, larga THUMBNAIL_WIDTH pixel.
+
+    Args:
+        original (np.ndarray): Immagine originale (BGR, anche vista in grigi di _as_bgr).
+        processed (np.ndarray): Immagine elaborata (idem), alta quanto l'originale.
+        copied (bool): Se True il lato elaborato è vuoto (nessuna pagina trovata).
+
+    Returns:
+        np.ndarray: Miniatura BGR.
+    """
+    sep_width = THUMBNAIL_SEPARATOR
+    resize_val = THUMBNAIL_WIDTH
+    height = original.shape[0]
+    left_width = original.shape[1]
+    right_width = left_width if copied else processed.shape[1]
+    width = left_width + sep_width + right_width
+
+    # Ogni lato viene ridimensionato direttamente nella sua parte della miniatura: nessuna
+    # striscia concatenata a piena risoluzione, larga il doppio dell'originale, da allocare e
+    # copiare. Il buffer non viene azzerato: si scrive a zero solo ciò che resta nero
+    thumbnail = np.empty((int(resize_val * height / width), resize_val) + original.shape[2:], dtype=np.uint8)
+    left_end = max(1, round(resize_val * left_width / width))
+    right_start = resize_val if copied else min(resize_val - 1, round(resize_val * (left_width + sep_width) / width))
+    thumbnail[:, left_end:right_start] = 0  # separatore (e lato elaborato vuoto se copied)
+
+    # INTER_AREA per ridurre (il caso normale); immagini più piccole della miniatura vengono
+    # ingrandite con INTER_LINEAR, dove INTER_AREA non porta vantaggi
+    interpolation = cv2.INTER_AREA if thumbnail.shape[0] < height else cv2.INTER_LINEAR
+    _resize_into(original, thumbnail[:, :left_end], interpolation)
+    if not copied:
+        _resize_into(processed, thumbnail[:, right_start:], interpolation)
+    return thumbnail
+
+
+def _np_default(obj):
+    """Hook `default` di json: converte scalari e array numpy nei tipi Python equivalenti."""
+    if isinstance(obj, np.integer):
+        return int(obj)
+    if isinstance(obj, np.floating):
+        return float(obj)
+    if isinstance(obj, np.bool_):
+        return bool(obj)
+    if isinstance(obj, np.ndarray):
+        return obj.tolist()
+    raise TypeError(f"Object of type {type(obj).__name__} is not JSON serializable")
+
+
+THUMBNAIL_CACHE_DIR = "cache"  # sottocartella delle miniature con la cache per contenuto
+THUMBNAIL_CACHE_MAX_ENTRIES = 5000  # miniature conservate in cache (le meno recenti vengono rimosse)
+
+
+def prune_thumbnail_cache(output_path_thumb, max_entries=THUMBNAIL_CACHE_MAX_ENTRIES):
+    """
+    Limita la cache delle miniature a max_entries file, rimuovendo quelli usati meno di recente
+    (mtime, aggiornato a ogni riuso). Le miniature con nome restano valide: sono hard link o copie.
+
+    Returns:
+        int: Numero di file rimossi.
+    """
+    cache_dir = os.path.join(output_path_thumb, THUMBNAIL_CACHE_DIR)
+    if not os.path.isdir(cache_dir):
+        return 0
+    with os.scandir(cache_dir) as entries:
+        files = [(entry.stat().st_mtime_ns, entry.path) for entry in entries if entry.is_file()]
+    if len(files) <= max_entries:
+        return 0
+    files.sort()
+    stale = files[:len(files) - max_entries]
+    for _, path in stale:
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+    return len(stale)
+
+
+def thumbnail_cache_key(original_path, processed, copied=False, stat=None):
+    """
+    Chiave della cache delle miniature: percorso, mtime e dimensione del file originale più
+    un'impronta del lato elaborato (forma e un campione 8x8 dei pixel), così una miniatura
+    viene riusata solo se originale ed elaborazione non sono cambiati.
+    stat è l'os.stat dell'originale, se il chiamante l'ha già letto.
+
+    Returns:
+        str: Chiave esadecimale di 16 caratteri, o None se l'originale non è accessibile.
+    """
+    if stat is None:
+        try:
+            stat = os.stat(original_path)
+        except (OSError, TypeError):
+            return None
+    digest = hashlib.blake2b(
+        f"{original_path}:{stat.st_mtime_ns}:{stat.st_size}:{copied}:{THUMBNAIL_WIDTH}:{THUMBNAIL_SEPARATOR}".encode())
+    if not copied and processed is not None:
+        digest.update(str(processed.shape).encode())
+        digest.update(cv2.resize(processed, (8, 8), interpolation=cv2.INTER_NEAREST).tobytes())
+    return digest.hexdigest()[:16]
+
+
+def save_outputs(original, processed, output_path_tiff, output_path_thumb=None, copied=False, output_no_cropped=None, original_path=None, use_compression=True, codec_workers=None, verbose=False,
+                 make_thumbnail=True, compute_quality=True, thumbnail_format='jpg', parallel=True):
+    """
+    Save the processed TIFF image, a reduced JPG (or WebP) thumbnail, and the quality evaluation JSON.
+    Always saves both original and processed images in the thumbnail, and always saves the quality file.
+    Now also preserves metadata from original images. When copied is True (no page found) the
+    original file is copied byte-for-byte and the thumbnail shows an empty processed side.
+    codec_workers is the number of threads tifffile may use to compress the TIFF; verbose
+    prints the quality evaluation.
+    If output_path_thumb is None or make_thumbnail is False no thumbnail is built or written (the
+    returned thumbnail is None). If compute_quality is False neither the quality evaluation nor the
+    metadata comparison is run and no quality JSON is written (quality_path is None).
+    Returns a dict with the thumbnail (None if not built, including when reused from the thumbnail
+    cache), the path of the quality JSON that was written and
+    metadata_preserved (True/False, or None when no metadata comparison was possible).
+    thumbnail_format is 'jpg' (default) or 'webp'; WebP falls back to JPEG when OpenCV was built
+    without it.
+    Thumbnail and quality JSON are written in background: call flush_writes() before reading them.
+    If output_path_thumb ends in .zip or .tar, thumbnails and quality JSONs (under quality/) are
+    stored in that archive instead of being written as separate files; quality_path is then an
+    (archive path, member name) tuple.
+    With parallel=True the TIFF, the thumbnail and the quality evaluation run concurrently on the
+    shared mt_loop pool; pass parallel=False when the caller already overlaps several images.
+    """
+    make_thumbnail = bool(make_thumbnail and output_path_thumb)
+    if thumbnail_format == 'webp' and not WEBP_AVAILABLE:
+        thumbnail_format = 'jpg'
+    thumbnail_ext, thumbnail_params = THUMBNAIL_ENCODERS[thumbnail_format]
+    to_archive = is_archive_path(output_path_thumb)
+
+    # Parti del percorso di output calcolate una volta sola
+    output_dir = os.path.dirname(output_path_tiff)
+    name_without_ext, output_ext = os.path.splitext(os.path.basename(output_path_tiff))
+    output_ext = output_ext.lower()
+    is_tiff = output_ext in ('.tiff', '.tif')
+    try:
+        original_stat = os.stat(original_path)
+    except (OSError, TypeError):
+        original_stat = None
+
+    def write_output():
+        """Salva il TIFF elaborato (con i metadati) e restituisce le informazioni di salvataggio."""
+        if copied and original_path:
+            # Nothing was detected: copy the original file as-is instead of re-encoding it
+            shutil.copyfile(original_path, output_path_tiff)
+            return {
+                "saved_successfully": True,
+                "metadata_preserved": True,
+                "format": output_ext.upper().replace('.', ''),
+                "compression": "copied",
+                "compression_requested": use_compression,
+                "error": None,
+            }
+        if original_path:
+            return save_image_with_metadata(processed, output_path_tiff, original_path, use_compression,
+                                            maxworkers=codec_workers)
         # Fallback: salvataggio con compressione opzionale
-        if output_path_tiff.lower().endswith(('.tiff', '.tif')):
+        if is_tiff and tifffile is not None:
+            save_tiff(processed, output_path_tiff, use_compression=use_compression, maxworkers=codec_workers)
+        elif is_tiff:
             if use_compression:
-                # Convert to PIL and save with LZW compression
-                if len(processed.shape) == 3:
-                    processed_rgb = cv2.cvtColor(processed, cv2.COLOR_BGR2RGB)
-                else:
-                    processed_rgb = processed
-                pil_image = Image.fromarray(processed_rgb)
-                print(f"Fallback: Saving TIFF with LZW compression")
-                pil_image.save(output_path_tiff, format='TIFF', compression='lzw')
+                # OpenCV scrive direttamente il BGR compresso (deflate + predittore), senza conversione PIL
+                print(f"Fallback: Saving TIFF with deflate compression")
+                cv2.imwrite(output_path_tiff, processed, CV2_TIFF_COMPRESSED)
             else:
                 print(f"Fallback: Saving TIFF without compression")
                 cv2.imwrite(output_path_tiff, processed)
-        elif output_path_tiff.lower().endswith('.png'):
+        elif output_ext == '.png':
             cv2.imwrite(output_path_tiff, processed, [cv2.IMWRITE_PNG_COMPRESSION, 0])
-        elif output_path_tiff.lower().endswith(('.jpg', '.jpeg')):
+        elif output_ext in ('.jpg', '.jpeg'):
             cv2.imwrite(output_path_tiff, processed, [cv2.IMWRITE_JPEG_QUALITY, 100])
         else:
             cv2.imwrite(output_path_tiff, processed)
+        return None
 
-    # Ensure both images have the same height
-    if original.shape[0] != processed.shape[0]:
-        height = min(original.shape[0], processed.shape[0])
-        original = cv2.resize(original, (int(original.shape[1] * height / original.shape[0]), height))
-        processed = cv2.resize(processed, (int(processed.shape[1] * height / processed.shape[0]), height))
-
-    # Ensure both images have the same type
-    if original.shape[2] != processed.shape[2]:
-        if len(original.shape) == 2:
-            original = cv2.cvtColor(original, cv2.COLOR_GRAY2BGR)
-        if len(processed.shape) == 2:
-            processed = cv2.cvtColor(processed, cv2.COLOR_GRAY2BGR)
-
-    # --- SEPARAZIONE VISIVA ---
-    sep_width = 100  # larghezza separatore
-    height = original.shape[0]
-    separator = 0 * np.ones((height, sep_width, 3), dtype=np.uint8)  # grigio chiaro
-
-    # Concatenate original, separator, processed
-    concatenated_image = cv2.hconcat([original, separator, processed])
-
-    resize_val = 800
-    height, width = concatenated_image.shape[:2]
-    thumbnail = cv2.resize(concatenated_image, (resize_val, int(resize_val * height / width)))
-
-    # Se non viene passato output_path_thumb, salva in una cartella tmp accanto all'output tiff
-    if not output_path_thumb:
-        output_dir = os.path.dirname(output_path_tiff)
-        output_path_thumb = os.path.join(output_dir, 'tmp')
-        os.makedirs(output_path_thumb, exist_ok=True)
-
-    # Extract the base filename and add timestamp for proper sorting
-    base_filename = os.path.basename(output_path_tiff)
-    name_without_ext = os.path.splitext(base_filename)[0]
-    timestamp = str(int(time.time() * 1000))  # milliseconds timestamp
-    thumbnail_filename = f"{timestamp}_{name_without_ext}.jpg"
-    
-    # Salva thumbnail con gestione errori migliorata
-    thumbnail_full_path = os.path.join(output_path_thumb, thumbnail_filename)
-    try:
-        success = cv2.imwrite(thumbnail_full_path, thumbnail, [cv2.IMWRITE_JPEG_QUALITY, 85])
-        if not success:
-            # Fallback con PIL
-            thumbnail_rgb = cv2.cvtColor(thumbnail, cv2.COLOR_BGR2RGB)
-            pil_thumbnail = Image.fromarray(thumbnail_rgb)
-            pil_thumbnail.save(thumbnail_full_path, format='JPEG', quality=85)
-    except Exception as e:
-        print(f"Warning: Failed to save thumbnail: {e}")
+    # Nome deterministico: il prefisso è l'mtime (ms) dell'originale, che mantiene l'ordinamento
+    # per data; rielaborare la stessa immagine sovrascrive la miniatura invece di accumularne copie.
+    # Il suffisso è un hash breve del percorso: file omonimi in sottocartelle diverse non si
+    # sovrascrivono a vicenda miniatura e JSON di qualità
+    path_hash = hashlib.blake2b(os.path.abspath(original_path or output_path_tiff).encode(),
+                                digest_size=4).hexdigest()
+    if original_stat is not None:
+        thumbnail_filename = f"{original_stat.st_mtime_ns // 1_000_000}_{name_without_ext}_{path_hash}{thumbnail_ext}"
+    else:
+        thumbnail_filename = f"{name_without_ext}_{path_hash}{thumbnail_ext}"
+
+    # The file on disk is written from `processed`; `shown` is what the thumbnail and
+    # the quality evaluation see
+    shown = processed
+    if copied:
+        # Il lato elaborato è vuoto: la miniatura lo disegna già nera, alla valutazione basta
+        # un piano di grigi a zero (nessuna copia BGR grande quanto l'originale)
+        shown = np.zeros(original.shape[:2], dtype=np.uint8) if compute_quality else None
 
-    # --- Calcola e salva la valutazione della qualità ---
-    if output_no_cropped is not None:
-        image_to_compare = output_no_cropped
+    # Ensure both images have the same height (always a downscale to the smaller one: INTER_AREA)
+    if not copied and (make_thumbnail or compute_quality) and original.shape[0] != shown.shape[0]:
+        height = min(original.shape[0], shown.shape[0])
+        original = cv2.resize(original, (int(original.shape[1] * height / original.shape[0]), height),
+                              interpolation=cv2.INTER_AREA)
+        shown = cv2.resize(shown, (int(shown.shape[1] * height / shown.shape[0]), height),
+                           interpolation=cv2.INTER_AREA)
+
+    def write_thumbnail():
+        """Costruisce e salva la miniatura originale | separatore | elaborata."""
+        if not make_thumbnail:
+            return None
+
+        thumbnail_full_path = os.path.join(output_path_thumb, thumbnail_filename)
+
+        # Miniatura già costruita per lo stesso originale e lo stesso risultato: si collega
+        # (o copia) quella in cache invece di rifare concatenazione, resize e codifica
+        # (la cache vive in una cartella, non dentro un archivio)
+        cache_key = None if to_archive else thumbnail_cache_key(original_path, shown, copied, stat=original_stat)
+        cache_path = None
+        if cache_key is not None:
+            cache_path = os.path.join(output_path_thumb, THUMBNAIL_CACHE_DIR, cache_key + thumbnail_ext)
+            if os.path.exists(cache_path):
+                # Nessuna decodifica: la miniatura in cache viene solo collegata (thumbnail None)
+                os.utime(cache_path)  # usata di recente: prune_thumbnail_cache la conserva
+                link_or_copy(cache_path, thumbnail_full_path)
+                return None
+
+        # Originale ed elaborata possono essere in grigi o BGRA: la miniatura è sempre BGR
+        thumbnail = build_thumbnail(_as_bgr(original), None if copied else _as_bgr(shown), copied=copied)
+
+        # Salva thumbnail con gestione errori migliorata: codifica in memoria, scrittura in background
+        try:
+            success, encoded = cv2.imencode(thumbnail_ext, thumbnail, thumbnail_params)
+            if success and to_archive:
+                append_to_archive_async(output_path_thumb, thumbnail_filename, encoded)
+            elif success and cache_path is not None:
+                # Scritta una volta sola, nella cache; il nome della miniatura è un hard link
+                os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+                write_file_async(cache_path, encoded, link_path=thumbnail_full_path)
+            elif success:
+                write_file_async(thumbnail_full_path, encoded)
+            else:
+                print(f"Warning: Failed to encode thumbnail {thumbnail_filename}")
+        except Exception as e:
+            print(f"Warning: Failed to save thumbnail: {e}")
+        return thumbnail
+
+    def evaluate():
+        """Calcola la valutazione della qualità."""
+        if not compute_quality:
+            return None
+        if output_no_cropped is not None:
+            image_to_compare = output_no_cropped
+        else:
+            # If no uncropped original is provided, use the processed image
+            image_to_compare = original
+        return evaluate_quality(image_to_compare, shown, verbose=verbose)
+
+    # Codifica del TIFF, miniatura e valutazione della qualità sono indipendenti e passano
+    # quasi tutto il tempo in codec/cv2 che rilasciano il GIL: girano in parallelo, a meno che
+    # il chiamante non elabori già più immagini insieme (pipeline)
+    tasks = (write_output, write_thumbnail, evaluate)
+    if parallel:
+        metadata_info, thumbnail, quality = mt_loop(lambda task: task(), tasks)
     else:
-        # If no uncropped original is provided, use the processed image
-        image_to_compare = original 
+        metadata_info, thumbnail, quality = [task() for task in tasks]
+
+    if not compute_quality:
+        return {
+            "thumbnail": thumbnail,
+            "quality_path": None,
+            "metadata_preserved": None,
+        }
 
-    quality = evaluate_quality(image_to_compare, processed)
-    
     # Add metadata information if available
     if metadata_info:
         quality["save_metadata_info"] = metadata_info
@@ -355,29 +1042,35 @@ def save_outputs(original, processed, output_path_tiff, output_path_thumb=None,
         metadata_comparison = compare_metadata(original_path, output_path_tiff)
         quality["metadata_comparison"] = metadata_comparison
 
-    quality_dir = os.path.join(os.path.dirname(output_path_thumb), 'quality')
-    quality_dir = os.path.abspath(quality_dir)
-    os.makedirs(quality_dir, exist_ok=True)
     quality_filename = os.path.splitext(thumbnail_filename)[0] + '.json'
-    quality_path = os.path.join(quality_dir, quality_filename)
-    
-    def to_python_type(obj):
-        if isinstance(obj, dict):
-            return {k: to_python_type(v) for k, v in obj.items()}
-        elif isinstance(obj, list):
-            return [to_python_type(x) for x in obj]
-        elif isinstance(obj, (np.integer, np.int32, np.int64)):
-            return int(obj)
-        elif isinstance(obj, (np.floating, np.float32, np.float64)):
-            return float(obj)
+    # I tipi numpy vengono convertiti da json solo quando li incontra, senza ricostruire
+    # ricorsivamente l'intero dizionario; il file viene scritto in background come la miniatura
+    quality_json = json.dumps(quality, indent=2, ensure_ascii=False, default=_np_default).encode('utf-8')
+
+    if to_archive:
+        # Il JSON va nello stesso archivio delle miniature, sotto quality/
+        quality_path = (output_path_thumb, 'quality/' + quality_filename)
+        append_to_archive_async(*quality_path, quality_json)
+    else:
+        if output_path_thumb:
+            quality_dir = os.path.join(os.path.dirname(output_path_thumb), 'quality')
         else:
-            return obj
-    
-    quality_py = to_python_type(quality)
-    with open(quality_path, 'w', encoding='utf-8') as f:
-        json.dump(quality_py, f, indent=2, ensure_ascii=False)
+            # Senza thumbnail il JSON di qualità va in una cartella accanto all'output tiff
+            quality_dir = os.path.join(output_dir, 'quality')
+        quality_dir = os.path.abspath(quality_dir)
+        os.makedirs(quality_dir, exist_ok=True)
+        quality_path = os.path.join(quality_dir, quality_filename)
+        write_file_async(quality_path, quality_json)
 
-    return thumbnail
+    metadata_preserved = None
+    if "metadata_comparison" in quality:
+        metadata_preserved = bool(quality["metadata_comparison"].get("metadata_preserved", False))
+
+    return {
+        "thumbnail": thumbnail,
+        "quality_path": quality_path,
+        "metadata_preserved": metadata_preserved,
+    }
 
 def is_image_valid(image_path):
     """
@@ -392,6 +1085,8 @@ def is_image_valid(image_path):
     """
     if not os.path.exists(image_path):
         return False
+    from PIL import Image
+
     try:
         with Image.open(image_path) as img:
             img.verify()  # Verifica integrità senza caricare tutto in memoria